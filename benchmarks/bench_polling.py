@@ -0,0 +1,244 @@
+'''
+Load benchmark for the Latitude polling pipeline.
+
+Runs local stand-ins for Google ClientLogin, the ha-latitude bridge and the maps
+geocoder, and drives the real LatitudeWrapper with a stub PluginAPI, N synthetic
+accounts and M known locations. At the end polls/sec, update latency percentiles,
+publishes/sec, CPU time and peak memory are reported.
+
+Usage: python benchmarks/bench_polling.py --accounts 500 --locations 5000 --duration 60
+'''
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+
+from twisted.internet import reactor, task
+from twisted.web import server, resource as web_resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+class StandIn(web_resource.Resource):
+    '''
+    Base class for the stand-in services, adds latency and random errors.
+    '''
+    isLeaf = True
+
+    def __init__(self, latency, error_rate):
+        web_resource.Resource.__init__(self)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+
+    def render(self, request):
+        self.requests += 1
+        delay = random.uniform(0.5, 1.5) * self.latency
+        task.deferLater(reactor, delay, self.respond, request)
+        return server.NOT_DONE_YET
+
+    def respond(self, request):
+        if random.random() < self.error_rate:
+            request.setResponseCode(500)
+            body = 'Internal error'
+        else:
+            body = self.answer(request)
+        request.write(body)
+        request.finish()
+
+class ClientLogin(StandIn):
+    def answer(self, request):
+        email = request.args['Email'][0]
+        return 'SID=sid\nLSID=lsid\nAuth=token-%s\n' % email
+
+class Bridge(StandIn):
+    '''
+    Returns a fix per account that moves now and then around the known locations.
+    Like the real bridge, /_ah/login sets a session cookie and redirects to the continue
+    URL, which only answers with JSON when the cookie is sent along.
+    '''
+    def __init__(self, latency, error_rate, locations, move_rate):
+        StandIn.__init__(self, latency, error_rate)
+        self.locations = locations
+        self.move_rate = move_rate
+        self.fixes = {}
+
+    def answer(self, request):
+        if request.path == '/_ah/login':
+            request.addCookie('ACSID', request.args['auth'][0], path='/')
+            request.redirect(request.args['continue'][0])
+            return ''
+
+        session = request.getCookie('ACSID')
+        if not session or not session.startswith('token-'):
+            return '<html><body>Login required</body></html>'
+
+        user = session[len('token-'):]
+        fix = self.fixes.get(user)
+        if fix is None or random.random() < self.move_rate:
+            lat, lon = random.choice(self.locations)
+            fix = [lat + random.gauss(0, 0.01), lon + random.gauss(0, 0.01), int(time.time() * 1000)]
+            self.fixes[user] = fix
+
+        return json.dumps({'data': {'latitude': fix[0], 'longitude': fix[1], 'timestampMs': str(fix[2])}})
+
+class Geocoder(StandIn):
+    def answer(self, request):
+        query = request.args['q'][0]
+        return json.dumps({'Placemark': [{'address': 'Street near %s' % query}]})
+
+class StubPluginAPI():
+    '''
+    Stands in for houseagent.plugins.pluginapi.PluginAPI, counts published values.
+    '''
+    instance = None
+
+    def __init__(self, *args, **kwargs):
+        self.published = 0
+        self.events = 0
+        StubPluginAPI.instance = self
+
+    def ready(self):
+        pass
+
+    def value_update(self, address, values):
+        if 'Current location' in values:
+            self.published += 1
+        else:
+            self.events += 1
+
+def install_stubs(config_dir):
+    houseagent = types.ModuleType('houseagent')
+    houseagent.config_path = config_dir
+    plugins = types.ModuleType('houseagent.plugins')
+    pluginapi = types.ModuleType('houseagent.plugins.pluginapi')
+    pluginapi.PluginAPI = StubPluginAPI
+    houseagent.plugins = plugins
+    plugins.pluginapi = pluginapi
+    sys.modules['houseagent'] = houseagent
+    sys.modules['houseagent.plugins'] = plugins
+    sys.modules['houseagent.plugins.pluginapi'] = pluginapi
+
+def write_config(config_dir, args, locations):
+    lines = ['[coordinator]', 'host = 127.0.0.1', 'port = 13001', '',
+             '[general]', 'id = benchmark', 'write_delay = 1', '',
+             '[locations]']
+    for i, (lat, lon) in enumerate(locations):
+        lines.append('location%d = %s' % (i, json.dumps([str(lat), str(lon)])))
+
+    lines += ['', '[accounts]']
+    for i in range(args.accounts):
+        lines.append('user%d@example.com = %s' % (i, json.dumps([i, 'secret', str(args.refreshtime), str(args.proximity)])))
+
+    lines += ['', '[scheduler]', 'jitter = 0.1', 'max_rate = %s' % args.max_rate,
+              '', '[http]', 'max_per_host = %d' % args.max_per_host, 'connect_timeout = 30', 'read_timeout = 60', 'gzip = false',
+              '', '[auth]', 'token_lifetime = 0', 'login_rate = 0', '']
+
+    os.makedirs(os.path.join(config_dir, 'latitude'))
+    with open(os.path.join(config_dir, 'latitude', 'latitude.conf'), 'wb') as f:
+        f.write('\n'.join(lines))
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def main():
+    parser = argparse.ArgumentParser(description='Latitude polling pipeline benchmark')
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--locations', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--refreshtime', type=float, default=5, help='account refresh time in seconds')
+    parser.add_argument('--proximity', type=float, default=0.5, help='account proximity in KM')
+    parser.add_argument('--max-rate', type=float, default=0, help='scheduler polls per second, 0 for no limit')
+    parser.add_argument('--max-per-host', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean stand-in latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of stand-in requests that fail')
+    parser.add_argument('--move-rate', type=float, default=0.2, help='fraction of polls returning a new fix')
+    args = parser.parse_args()
+
+    random.seed(1)
+    locations = [(random.uniform(50, 54), random.uniform(3, 7)) for _ in range(args.locations)]
+
+    config_dir = tempfile.mkdtemp()
+    write_config(config_dir, args, locations)
+    install_stubs(config_dir)
+
+    import latitude
+
+    auth = ClientLogin(args.latency, args.error_rate)
+    bridge = Bridge(args.latency, args.error_rate, locations, args.move_rate)
+    geocoder = Geocoder(args.latency, args.error_rate)
+    root = web_resource.Resource()
+    root.putChild('ClientLogin', auth)
+    root.putChild('_ah', bridge)
+    root.putChild('', bridge)
+    root.putChild('geo', geocoder)
+    port = reactor.listenTCP(0, server.Site(root), interface='127.0.0.1')
+    base = 'http://127.0.0.1:%d' % port.getHost().port
+
+    latitude.Latitude.AUTH_URI = base + '/ClientLogin'
+    latitude.Latitude.BRIDGE_API = base
+    latitude.Latitude.GEOCODE_URI = base + '/geo'
+
+    wrapper = latitude.LatitudeWrapper()
+    poller = wrapper.latitude
+    latencies = []
+    failures = [0]
+    update = poller.update
+
+    def timed_update(account):
+        start = time.time()
+        d = update(account)
+
+        def done(result):
+            latencies.append(time.time() - start)
+            return result
+
+        def failed(failure):
+            failures[0] += 1
+            return failure
+
+        return d.addCallbacks(done, failed)
+
+    poller.update = timed_update
+
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+
+    def report():
+        wall = time.time() - start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (usage.ru_utime - start_usage.ru_utime) + (usage.ru_stime - start_usage.ru_stime)
+        api = StubPluginAPI.instance
+
+        print 'accounts:           %d' % args.accounts
+        print 'locations:          %d' % args.locations
+        print 'duration:           %.1f s' % wall
+        print 'polls:              %d (%.1f/s)' % (len(latencies), len(latencies) / wall)
+        print 'failed polls:       %d' % failures[0]
+        print 'update latency p50: %.1f ms' % (percentile(latencies, 50) * 1000)
+        print 'update latency p99: %.1f ms' % (percentile(latencies, 99) * 1000)
+        print 'publishes:          %d (%.1f/s)' % (api.published, api.published / wall)
+        print 'requests:           login %d, bridge %d, geocode %d' % (auth.requests, bridge.requests, geocoder.requests)
+        print 'cpu:                %.2f s (%.0f%%)' % (cpu, 100.0 * cpu / wall)
+        # ru_maxrss is in kilobytes on Linux and bytes on OS X
+        scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+        print 'peak memory:        %.1f MB' % (usage.ru_maxrss / scale)
+        print 'http:               %s' % wrapper.http.stats()
+        print 'geocode cache:      %s' % wrapper.geocode_cache.stats()
+
+        reactor.stop()
+
+    reactor.callLater(args.duration, report)
+    reactor.run()
+    shutil.rmtree(config_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from twisted.internet import reactor, defer
+
+class ChangeLog():
+    '''
+    This class keeps the latest change of every key with a sequence number,
+    so clients can ask for everything that changed since the last sequence number they saw.
+    Waiting clients are woken up by the next change, nothing runs while nothing changes.
+    '''
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self.seq = 0
+        self.changes = OrderedDict()
+        self.waiters = []
+
+    def record(self, key, value):
+        '''
+        Record the new value of a key.
+        @param key: the changed key
+        @param value: the new value, None when the key was removed
+        '''
+        self.seq += 1
+        # Keep the entries ordered by sequence number
+        self.changes.pop(key, None)
+        self.changes[key] = (self.seq, value)
+
+        waiters, self.waiters = self.waiters, []
+        for d, timeout in waiters:
+            if timeout.active():
+                timeout.cancel()
+            d.callback(self.since(d.since))
+
+    def remove(self, key):
+        self.record(key, None)
+
+    def since(self, seq):
+        '''
+        Get the changes after a sequence number.
+        @param seq: the last sequence number seen, None to only get the current sequence number
+        @return: dictionary with the current sequence number and the changed keys and values
+        '''
+        changes = {}
+        # A sequence number from before a restart gets everything
+        if seq is not None and seq <= self.seq:
+            for key in reversed(self.changes):
+                key_seq, value = self.changes[key]
+                if key_seq <= seq:
+                    break
+                changes[key] = value
+        elif seq is not None:
+            changes = dict((key, value) for key, (key_seq, value) in self.changes.iteritems())
+
+        return {'seq': self.seq, 'changes': changes}
+
+    def wait(self, seq, timeout=20):
+        '''
+        Wait for changes after a sequence number.
+        @param seq: the last sequence number seen, None to only get the current sequence number
+        @param timeout: number of seconds to wait before answering without changes
+        @return: a Deferred firing with the result of since
+        '''
+        result = self.since(seq)
+        if result['changes'] or seq is None or seq != self.seq:
+            return defer.succeed(result)
+
+        d = defer.Deferred()
+        d.since = seq
+        entry = (d, self.clock.callLater(timeout, self._expire, d))
+        self.waiters.append(entry)
+        return d
+
+    def _expire(self, d):
+        self.waiters = [entry for entry in self.waiters if entry[0] is not d]
+        d.callback(self.since(d.since))
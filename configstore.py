@@ -0,0 +1,213 @@
+import os
+import json
+import pickle
+import ConfigParser
+from collections import OrderedDict
+from twisted.internet import reactor, defer, threads
+from twisted.python import log
+
+class ConfigStore():
+    '''
+    This class keeps the Latitude configuration file in memory.
+    Changes are batched and written to disk in a thread after a short delay,
+    using a temporary file and a rename so the file is never left half written.
+
+    Values in the serialized sections (locations, accounts and tokens) are stored as JSON.
+    Files still using the old pickle format are converted when they are loaded, after that
+    the file is marked with [general] format = json and pickled values are no longer read.
+    Values that can not be read are logged and left in the file as they are.
+    '''
+    FORMAT = 'json'
+
+    def __init__(self, filename, serialized=('locations', 'accounts', 'tokens'), delay=1.0):
+        '''
+        @param filename: the configuration file
+        @param serialized: sections holding JSON encoded values
+        @param delay: time in seconds to wait for more changes before writing
+        '''
+        self.filename = filename
+        self.serialized = serialized
+        self.delay = delay
+        self.sections = OrderedDict()
+        self.invalid = {}
+        self.timer = None
+        self.writing = None
+        self.dirty = False
+
+        self.load()
+        if self.dirty:
+            reactor.callWhenRunning(self.changed)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+
+    def load(self):
+        '''
+        Read the configuration file, converting pickled values to JSON.
+        '''
+        config = ConfigParser.RawConfigParser(dict_type=OrderedDict)
+        config.optionxform = str
+        config.read(self.filename)
+        migrated = self.is_migrated(config)
+
+        for section in config.sections():
+            items = self.sections[section] = OrderedDict()
+            for option, value in config.items(section):
+                if section in self.serialized:
+                    try:
+                        value = self.decode(value, migrated)
+                    except Exception, e:
+                        self.invalid.setdefault(section, OrderedDict())[option] = value
+                        log.msg('Ignoring invalid value of %s in [%s] of %s: %s' % (option, section, self.filename, e))
+                        continue
+                items[option] = value
+
+        for section in self.serialized:
+            self.sections.setdefault(section, OrderedDict())
+
+        if not migrated:
+            self.sections.setdefault('general', OrderedDict())['format'] = self.FORMAT
+            self.dirty = True
+
+    def is_migrated(self, config):
+        '''
+        Whether a configuration file was written in the JSON format, so pickled values must not be read.
+        '''
+        return config.has_option('general', 'format') and config.get('general', 'format') == self.FORMAT
+
+    def import_sections(self, filename, sections):
+        '''
+        Copy sections from another configuration file, sections that already have options are left alone.
+        @param filename: the configuration file to import from
+        @param sections: the names of the sections to import
+        @return: the names of the imported sections
+        '''
+        config = ConfigParser.RawConfigParser(dict_type=OrderedDict)
+        config.optionxform = str
+        config.read(filename)
+        migrated = self.is_migrated(config)
+
+        imported = []
+        for section in sections:
+            if self.sections.get(section) or not config.has_section(section) or not config.items(section):
+                continue
+
+            items = self.sections[section] = OrderedDict()
+            for option, value in config.items(section):
+                if section in self.serialized:
+                    try:
+                        value = self.decode(value, migrated)
+                    except Exception, e:
+                        log.msg('Not importing invalid value of %s in [%s] of %s: %s' % (option, section, filename, e))
+                        continue
+                items[option] = value
+            imported.append(section)
+
+        if imported:
+            self.changed()
+        return imported
+
+    def decode(self, value, migrated):
+        '''
+        Decode a serialized value.
+        @param migrated: whether the file is in the JSON format, otherwise pickled values are converted
+        '''
+        try:
+            return json.loads(value)
+        except ValueError:
+            if migrated:
+                raise
+            # One time migration from the pickle based format
+            self.dirty = True
+            try:
+                return pickle.loads(value)
+            except Exception:
+                raise ValueError('neither JSON nor a pickled value')
+
+    def items(self, section):
+        '''
+        Get all options of a section.
+        @return: dictionary of option to value, do not modify it directly
+        '''
+        return self.sections.get(section, {})
+
+    def get(self, section, option, default=None):
+        return self.sections.get(section, {}).get(option, default)
+
+    def set(self, section, option, value):
+        '''
+        Set an option, the change is written to disk later.
+        '''
+        self.sections.setdefault(section, OrderedDict())[option] = value
+        self.invalid.get(section, {}).pop(option, None)
+        self.changed()
+
+    def remove(self, section, option):
+        '''
+        Remove an option, the change is written to disk later.
+        '''
+        if self.sections.get(section, {}).pop(option, None) is not None or \
+           self.invalid.get(section, {}).pop(option, None) is not None:
+            self.changed()
+
+    def changed(self):
+        self.dirty = True
+        if not self.timer and not self.writing and reactor.running:
+            self.timer = reactor.callLater(self.delay, self.flush)
+
+    def flush(self):
+        '''
+        Write pending changes to disk.
+        @return: a Deferred firing when the configuration file is written
+        '''
+        if self.timer and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+        if self.writing:
+            return self.writing.addCallback(lambda _: self.flush())
+
+        if not self.dirty:
+            return defer.succeed(None)
+
+        self.dirty = False
+        snapshot = [(section, items.items()) for section, items in self.sections.iteritems()]
+        invalid = dict((section, items.items()) for section, items in self.invalid.iteritems())
+
+        self.writing = threads.deferToThread(self.write, snapshot, invalid)
+        self.writing.addErrback(self.write_failed)
+        self.writing.addBoth(self.written)
+        return self.writing
+
+    def write(self, snapshot, invalid):
+        config = ConfigParser.RawConfigParser(dict_type=OrderedDict)
+        config.optionxform = str
+        for section, items in snapshot:
+            config.add_section(section)
+            for option, value in items:
+                if section in self.serialized:
+                    value = json.dumps(value, separators=(',', ':'))
+                config.set(section, option, value)
+
+            # Keep values that could not be read so they can be fixed by hand
+            for option, value in invalid.get(section, ()):
+                if not config.has_option(section, option):
+                    config.set(section, option, value)
+
+        temp = self.filename + '.tmp'
+        with open(temp, 'wb') as configfile:
+            config.write(configfile)
+            configfile.flush()
+            os.fsync(configfile.fileno())
+
+        if os.name == 'nt' and os.path.exists(self.filename):
+            # Windows can not rename over an existing file
+            os.remove(self.filename)
+        os.rename(temp, self.filename)
+
+    def write_failed(self, failure):
+        log.err(failure, 'Unable to write %s' % self.filename)
+        self.dirty = True
+
+    def written(self, result):
+        self.writing = None
+        if self.dirty:
+            self.changed()
@@ -0,0 +1,163 @@
+import os
+import sys
+import csv
+import mmap
+import struct
+from array import array
+from math import sin, cos, asin, sqrt, pi
+
+from geoindex import EARTH_RADIUS
+
+MAGIC = 'LATGAZ1\0'
+HEADER = struct.Struct('<8sI')
+VECTOR = struct.Struct('<3d')
+OFFSETS = struct.Struct('<2I')
+
+def to_vector(lat, lon):
+    '''
+    Convert a position in degrees to a vector on the unit sphere.
+    '''
+    rlat = lat * pi / 180.0
+    rlon = lon * pi / 180.0
+    return cos(rlat) * cos(rlon), cos(rlat) * sin(rlon), sin(rlat)
+
+class Gazetteer():
+    '''
+    This class resolves positions to the nearest populated place offline.
+    Places are read from a GeoNames style tab separated file and stored in a
+    KD-tree over unit sphere vectors. The tree is written to a binary cache file
+    next to the dataset, which is memory mapped on later starts so the dataset
+    does not have to be parsed again. Lookups read the vectors and names
+    straight from the mapped file, nothing is copied into memory.
+    '''
+    def __init__(self, filename, max_distance=50):
+        '''
+        @param filename: the GeoNames style dataset (for example cities1000.txt)
+        @param max_distance: maximum distance in KM to a place, 0 for no limit
+        '''
+        self.max_distance = max_distance
+        cache = filename + '.idx'
+
+        if not os.path.exists(cache) or os.path.getmtime(cache) < os.path.getmtime(filename):
+            self.build(filename, cache)
+
+        self.load(cache)
+
+    def build(self, filename, cache):
+        '''
+        Parse the dataset, build the KD-tree and write it to the cache file.
+        '''
+        points = []
+        with open(filename, 'rb') as f:
+            for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                try:
+                    lat, lon = float(row[4]), float(row[5])
+                except (IndexError, ValueError):
+                    continue
+
+                name = row[1]
+                if len(row) > 8 and row[8]:
+                    name = '%s, %s' % (name, row[8])
+                points.append(to_vector(lat, lon) + (name,))
+
+        ordered = []
+        self._build(points, 0, ordered)
+
+        coords = array('d')
+        offsets = array('I', [0])
+        names = []
+        for x, y, z, name in ordered:
+            coords.extend((x, y, z))
+            names.append(name)
+            offsets.append(offsets[-1] + len(name))
+
+        # The index is little endian, it is read with struct
+        if sys.byteorder == 'big':
+            coords.byteswap()
+            offsets.byteswap()
+
+        temp = cache + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(ordered)))
+            f.write(coords.tostring())
+            f.write(offsets.tostring())
+            f.write(''.join(names))
+
+        if os.name == 'nt' and os.path.exists(cache):
+            os.remove(cache)
+        os.rename(temp, cache)
+
+    def _build(self, points, depth, ordered):
+        # Store the tree implicitly: the median of every range is its root
+        if not points:
+            return
+
+        axis = depth % 3
+        points.sort(key=lambda p: p[axis])
+        mid = len(points) // 2
+        self._build(points[:mid], depth + 1, ordered)
+        ordered.append(points[mid])
+        self._build(points[mid + 1:], depth + 1, ordered)
+
+    def load(self, cache):
+        '''
+        Memory map the cache file.
+        '''
+        with open(cache, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a gazetteer index' % cache)
+
+        self.offsets_start = HEADER.size + self.count * 24
+        self.names_start = self.offsets_start + (self.count + 1) * 4
+
+    def __len__(self):
+        return self.count
+
+    def name(self, i):
+        start, end = OFFSETS.unpack_from(self.map, self.offsets_start + i * 4)
+        return self.map[self.names_start + start:self.names_start + end].decode('utf-8')
+
+    def nearest(self, lat, lon):
+        '''
+        Get the nearest place.
+        @param lat: latitude in degrees
+        @param lon: longitude in degrees
+        @return: tuple of (place name, distance in KM), or None when no place is near enough
+        '''
+        if not self.count:
+            return None
+
+        query = to_vector(float(lat), float(lon))
+        best = [None, 4.0]
+        self._search(query, 0, self.count, 0, best)
+
+        km = 2.0 * EARTH_RADIUS * asin(min(1.0, sqrt(best[1]) / 2.0))
+        if self.max_distance and km > self.max_distance:
+            return None
+        return self.name(best[0]), km
+
+    def _search(self, query, lo, hi, depth, best):
+        if lo >= hi:
+            return
+
+        mid = (lo + hi) // 2
+        x, y, z = VECTOR.unpack_from(self.map, HEADER.size + mid * 24)
+        dx = query[0] - x
+        dy = query[1] - y
+        dz = query[2] - z
+        d2 = dx * dx + dy * dy + dz * dz
+        if d2 < best[1]:
+            best[0], best[1] = mid, d2
+
+        diff = (dx, dy, dz)[depth % 3]
+        if diff < 0:
+            first, second = (lo, mid), (mid + 1, hi)
+        else:
+            first, second = (mid + 1, hi), (lo, mid)
+
+        self._search(query, first[0], first[1], depth + 1, best)
+        if diff * diff < best[1]:
+            self._search(query, second[0], second[1], depth + 1, best)
@@ -0,0 +1,189 @@
+import time
+import sqlite3
+from collections import OrderedDict
+from twisted.internet import reactor, defer, threads
+from twisted.python import log
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def geohash(latitude, longitude, precision):
+    '''
+    Encode a position as a geohash string.
+    @param latitude: latitude in degrees
+    @param longitude: longitude in degrees
+    @param precision: number of characters in the geohash
+    @return: the geohash string
+    '''
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    result = []
+    bit = 0
+    ch = 0
+    even = True
+
+    while len(result) < precision:
+        if even:
+            value, interval = longitude, lon_range
+        else:
+            value, interval = latitude, lat_range
+
+        mid = (interval[0] + interval[1]) / 2
+        if value >= mid:
+            ch |= 16 >> bit
+            interval[0] = mid
+        else:
+            interval[1] = mid
+
+        even = not even
+        if bit < 4:
+            bit += 1
+        else:
+            result.append(GEOHASH_BASE32[ch])
+            bit = 0
+            ch = 0
+
+    return ''.join(result)
+
+class GeocodeCache():
+    '''
+    This class caches reverse geocode results keyed on a geohash of the position.
+    Entries are held in a bounded LRU in memory and optionally in a SQLite file
+    so they survive restarts. Changes to the file are batched and written in a thread.
+    '''
+    def __init__(self, precision=7, size=1000, ttl=86400, filename=None, delay=5.0):
+        '''
+        @param precision: geohash length used to quantize positions (7 is about 150 metres)
+        @param size: maximum number of entries kept in memory
+        @param ttl: time in seconds after which an entry is no longer used
+        @param filename: optional SQLite file used as backing store
+        @param delay: time in seconds to wait for more changes before writing them to the file
+        '''
+        self.precision = precision
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.delay = delay
+        self.pending = {}
+        self.timer = None
+        self.writing = None
+        self.db = None
+
+        if filename:
+            self.db = sqlite3.connect(filename)
+            # Lookups on the reactor thread are not blocked by the writer
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, address TEXT, stored REAL)')
+            self.db.execute('DELETE FROM geocode WHERE stored < ?', (time.time() - self.ttl,))
+            self.db.commit()
+            # Only used by one write thread at a time
+            self.writer = sqlite3.connect(filename, check_same_thread=False)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+
+    def key(self, latitude, longitude):
+        '''
+        Get the cache key for a position.
+        '''
+        return geohash(float(latitude), float(longitude), self.precision)
+
+    def get(self, latitude, longitude):
+        '''
+        Get a cached address for a position.
+        @return: the address or None when it is not cached or has expired
+        '''
+        key = self.key(latitude, longitude)
+        entry = self.entries.pop(key, None)
+
+        if entry is None and key in self.pending:
+            entry = self.pending[key]
+        elif entry is None and self.db:
+            row = self.db.execute('SELECT address, stored FROM geocode WHERE key = ?', (key,)).fetchone()
+            if row:
+                entry = row
+
+        if entry is not None and entry[1] + self.ttl < time.time():
+            self.expired += 1
+            entry = None
+            if self.db:
+                self.changed(key, None)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._store(key, entry)
+        return entry[0]
+
+    def put(self, latitude, longitude, address):
+        '''
+        Store the address for a position.
+        '''
+        key = self.key(latitude, longitude)
+        entry = (address, time.time())
+        self.entries.pop(key, None)
+        self._store(key, entry)
+
+        if self.db:
+            self.changed(key, entry)
+
+    def changed(self, key, entry):
+        '''
+        Queue a change of the file, None as entry removes the key.
+        '''
+        self.pending[key] = entry
+        if not self.timer and not self.writing and reactor.running:
+            self.timer = reactor.callLater(self.delay, self.flush)
+
+    def flush(self):
+        '''
+        Write the queued changes to the file.
+        @return: a Deferred firing when the changes are written
+        '''
+        if self.timer and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+        if self.writing:
+            return self.writing.addCallback(lambda _: self.flush())
+
+        if not self.pending:
+            return defer.succeed(None)
+
+        changes, self.pending = self.pending, {}
+        self.writing = threads.deferToThread(self._write, changes)
+        self.writing.addErrback(log.err, 'Unable to write the geocode cache')
+        self.writing.addBoth(self._written)
+        return self.writing
+
+    def _write(self, changes):
+        self.writer.executemany('INSERT OR REPLACE INTO geocode (key, address, stored) VALUES (?, ?, ?)',
+                                [(key, entry[0], entry[1]) for key, entry in changes.iteritems() if entry is not None])
+        self.writer.executemany('DELETE FROM geocode WHERE key = ?',
+                                [(key,) for key, entry in changes.iteritems() if entry is None])
+        self.writer.commit()
+
+    def _written(self, result):
+        self.writing = None
+        if self.pending:
+            self.timer = reactor.callLater(self.delay, self.flush)
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        '''
+        Get the cache counters.
+        @return: dictionary with cache statistics
+        '''
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'size': len(self.entries)}
@@ -0,0 +1,67 @@
+class GeofenceEngine():
+    '''
+    This class tracks which known locations each account is in.
+    An account enters a location within the enter radius and only exits it again
+    outside the larger exit radius, so GPS noise at the boundary does not cause flapping.
+    For locations with their own radius or a polygon the same hysteresis band,
+    the difference between both radii, is applied around their boundary.
+    A dwell event is generated once an account has been inside a location for the dwell time.
+    '''
+    def __init__(self, index, enter_factor=1.0, exit_factor=1.5, dwell_time=300):
+        '''
+        @param index: the LocationIndex holding the known locations
+        @param enter_factor: enter radius as a factor of the account proximity
+        @param exit_factor: exit radius as a factor of the account proximity
+        @param dwell_time: time in seconds inside a location before a dwell event
+        '''
+        self.index = index
+        self.enter_factor = enter_factor
+        self.exit_factor = max(exit_factor, enter_factor)
+        self.dwell_time = dwell_time
+        self.states = {}
+
+    def update(self, account, now):
+        '''
+        Update the geofence state of an account with its current fix.
+        Only locations the account is in and locations near the fix are evaluated.
+        @param account: the account with the current fix
+        @param now: the current time in seconds
+        @return: tuple of a list of (event, location) tuples and the nearest location
+                 the account is in, or None
+        '''
+        state = self.states.setdefault(account.username, {})
+        proximity = float(account.proximity)
+        enter_radius = proximity * self.enter_factor
+        band = proximity * (self.exit_factor - self.enter_factor)
+        lat, lon = account.latitude, account.longitude
+        events = []
+
+        for name, since in state.items():
+            excess = self.index.excess(name, lat, lon, enter_radius)
+            if excess is None or excess > band:
+                del state[name]
+                events.append(('exit', name))
+
+        for name in self.index.candidates(lat, lon, enter_radius):
+            if name not in state and self.index.excess(name, lat, lon, enter_radius) < 0:
+                state[name] = [now, False]
+                events.append(('enter', name))
+
+        inside = None
+        nearest = None
+        for name, since in state.iteritems():
+            if not since[1] and now - since[0] >= self.dwell_time:
+                since[1] = True
+                events.append(('dwell', name))
+
+            km = self.index.distance(name, lat, lon)
+            if nearest is None or km < nearest:
+                inside, nearest = name, km
+
+        return events, inside
+
+    def remove(self, username):
+        '''
+        Forget the state of an account.
+        '''
+        self.states.pop(username, None)
@@ -0,0 +1,469 @@
+from math import sin, cos, atan2, sqrt, pi, floor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EARTH_RADIUS = 6371.0
+KM_PER_DEGREE = EARTH_RADIUS * pi / 180.0
+
+def haversine(lat1, lon1, coslat1, lat2, lon2, coslat2):
+    '''
+    Get distance in km between two locations given in radians.
+    The cosine of both latitudes is passed in so callers can precompute it.
+    @param lat1: latitude of location A in radians
+    @param lon1: longitude of location A in radians
+    @param coslat1: cosine of lat1
+    @param lat2: latitude of location B in radians
+    @param lon2: longitude of location B in radians
+    @param coslat2: cosine of lat2
+    @return: distance between both locations in KM
+    '''
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = (sin(dlat/2))**2 + coslat1 * coslat2 * (sin(dlon/2.0))**2
+    c = 2.0 * atan2(sqrt(a), sqrt(1.0-a))
+    return EARTH_RADIUS * c
+
+def unwrap_longitude(lon, reference):
+    '''
+    Shift a longitude by whole turns so it is within 180 degrees of a reference longitude.
+    '''
+    return reference + (lon - reference + 180.0) % 360.0 - 180.0
+
+def in_longitude_range(lon, west, east):
+    '''
+    Check whether a longitude is between two others, the range may extend past 180 degrees.
+    '''
+    return (lon - west) % 360.0 <= east - west
+
+def parse_location(data):
+    '''
+    Parse the details of a known location.
+    @param data: list of latitude, longitude and optionally a radius in KM and a polygon
+                 given as a list of [latitude, longitude] vertices. Without a radius the
+                 account proximity is used, for polygons latitude and longitude may be
+                 left empty to use the center of the vertices.
+    @return: tuple of latitude, longitude, radius or None and list of vertices or None.
+             The longitudes of the vertices are unwrapped relative to the first vertex,
+             so polygons crossing 180 degrees have longitudes past it.
+    '''
+    polygon = None
+    if len(data) > 3 and data[3]:
+        polygon = [(float(v[0]), float(v[1])) for v in data[3]]
+        if len(polygon) < 3:
+            raise ValueError('A polygon needs at least three vertices')
+        polygon = [(v[0], unwrap_longitude(v[1], polygon[0][1])) for v in polygon]
+
+    radius = None
+    if len(data) > 2 and data[2] not in (None, ''):
+        radius = float(data[2])
+
+    if polygon and data[0] in (None, '') and data[1] in (None, ''):
+        lat = sum(v[0] for v in polygon) / len(polygon)
+        lon = unwrap_longitude(sum(v[1] for v in polygon) / len(polygon), 0.0)
+    else:
+        lat, lon = float(data[0]), float(data[1])
+
+    return lat, lon, radius, polygon
+
+def point_in_polygon(lat, lon, polygon):
+    '''
+    Check whether a position is inside a polygon, using ray casting.
+    @param polygon: list of (latitude, longitude) vertices, unwrapped as by parse_location
+    '''
+    lon = unwrap_longitude(lon, polygon[0][1])
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lon_i = polygon[i]
+        lat_j, lon_j = polygon[j]
+        if (lat_i > lat) != (lat_j > lat) and \
+           lon < (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i:
+            inside = not inside
+        j = i
+
+    return inside
+
+def polygon_edge_distance(lat, lon, polygon):
+    '''
+    Get the distance in KM from a position to the nearest edge of a polygon.
+    Uses a local flat projection, which is accurate enough for polygons the size of a site.
+    '''
+    scale = cos(lat * pi / 180.0) * KM_PER_DEGREE
+    lon = unwrap_longitude(lon, polygon[0][1])
+    points = [((v[1] - lon) * scale, (v[0] - lat) * KM_PER_DEGREE) for v in polygon]
+    best = None
+
+    for i in range(len(points)):
+        x1, y1 = points[i - 1]
+        x2, y2 = points[i]
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        t = 0.0 if length == 0 else max(0.0, min(1.0, -(x1 * dx + y1 * dy) / length))
+        km = sqrt((x1 + t * dx)**2 + (y1 + t * dy)**2)
+        if best is None or km < best:
+            best = km
+
+    return best
+
+class LocationIndex():
+    '''
+    This class implements a grid bucket index over the known locations.
+    Coordinates are parsed and converted to radians once when the index is built,
+    lookups only visit the grid cells that overlap the search radius.
+
+    Locations with their own radius or a polygon are kept in a separate grid holding
+    their bounding boxes, so exact tests only run for the few shapes whose bounds
+    contain the position.
+    '''
+    # Shapes covering more cells than this are checked for every lookup
+    MAX_SHAPE_CELLS = 10000
+
+    def __init__(self, locations, cell_size=0.1):
+        '''
+        @param locations: dictionary of location name to location details, see parse_location
+        @param cell_size: size of a grid cell in degrees
+        '''
+        self.cell_size = float(cell_size)
+        self.columns = int(round(360.0 / self.cell_size))
+        self.cells = {}
+        self.entries = {}
+        self.shape_cells = {}
+        self.shapes = {}
+        self.large_shapes = set()
+        self.version = 0
+
+        for name, data in locations.iteritems():
+            try:
+                self.set(name, data)
+            except (TypeError, ValueError, IndexError):
+                continue
+
+    def __len__(self):
+        return len(self.entries) + len(self.shapes)
+
+    def set(self, name, data):
+        '''
+        Add or replace a location from its details.
+        @param name: name of the location
+        @param data: location details, see parse_location
+        @raise ValueError: when the details can not be parsed
+        '''
+        lat, lon, radius, polygon = parse_location(data)
+
+        if radius is None and polygon is None:
+            self.add(name, lat, lon)
+        else:
+            self.add_shape(name, lat, lon, radius, polygon)
+
+    def add_shape(self, name, lat, lon, radius=None, polygon=None):
+        '''
+        Add a location with its own radius or a polygon to the index.
+        @param name: name of the location
+        @param lat: latitude of the center in degrees
+        @param lon: longitude of the center in degrees
+        @param radius: radius in KM, used when there is no polygon
+        @param polygon: list of (latitude, longitude) vertices
+        '''
+        self.remove(name)
+
+        if polygon:
+            bbox = (min(v[0] for v in polygon), min(v[1] for v in polygon),
+                    max(v[0] for v in polygon), max(v[1] for v in polygon))
+        else:
+            dlat = radius / KM_PER_DEGREE
+            coslat = cos(min(abs(lat) + dlat, 90.0) * pi / 180.0)
+            dlon = dlat / coslat if coslat > 0.0 else 180.0
+            bbox = (lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+
+        # The box may extend past 180 degrees, its columns wrap around
+        row_min = self._cell(max(bbox[0], -90.0), 0.0)[0]
+        row_max = self._cell(min(bbox[2], 90.0), 0.0)[0]
+        col_min = int(floor((bbox[1] + 180.0) / self.cell_size))
+        span = min(int(floor((bbox[3] + 180.0) / self.cell_size)) - col_min + 1, self.columns)
+        cells = [(row, (col_min + c) % self.columns) for row in range(row_min, row_max + 1) for c in range(span)]
+
+        if len(cells) > self.MAX_SHAPE_CELLS:
+            cells = []
+            self.large_shapes.add(name)
+
+        for cell in cells:
+            self.shape_cells.setdefault(cell, []).append(name)
+
+        rlat = lat * pi / 180.0
+        self.shapes[name] = (rlat, lon * pi / 180.0, cos(rlat), bbox, radius, polygon, cells)
+        self.version += 1
+
+    def _cell(self, lat, lon):
+        row = int(floor((lat + 90.0) / self.cell_size))
+        col = int(floor((lon + 180.0) / self.cell_size)) % self.columns
+        return row, col
+
+    def add(self, name, lat, lon):
+        '''
+        Add a location to the index.
+        @param name: name of the location
+        @param lat: latitude in degrees
+        @param lon: longitude in degrees
+        '''
+        self.remove(name)
+
+        rlat = lat * pi / 180.0
+        rlon = lon * pi / 180.0
+        cell = self._cell(lat, lon)
+        self.entries[name] = (rlat, rlon, cos(rlat), cell)
+        self.cells.setdefault(cell, []).append(name)
+        self.version += 1
+
+    def remove(self, name):
+        '''
+        Remove a location from the index.
+        @param name: name of the location
+        '''
+        entry = self.entries.pop(name, None)
+        if entry:
+            bucket = self.cells[entry[3]]
+            bucket.remove(name)
+            if not bucket:
+                del self.cells[entry[3]]
+            self.version += 1
+
+        shape = self.shapes.pop(name, None)
+        if shape:
+            for cell in shape[6]:
+                bucket = self.shape_cells[cell]
+                bucket.remove(name)
+                if not bucket:
+                    del self.shape_cells[cell]
+            self.large_shapes.discard(name)
+            self.version += 1
+
+    def shape_candidates(self, lat, lon, margin=0):
+        '''
+        Get the names of all shapes whose bounding box, grown by the margin, contains the position.
+        @param lat: latitude in degrees
+        @param lon: longitude in degrees
+        @param margin: margin in KM
+        '''
+        if not margin:
+            for names in (self.shape_cells.get(self._cell(lat, lon), ()), self.large_shapes):
+                for name in names:
+                    bbox = self.shapes[name][3]
+                    if bbox[0] <= lat <= bbox[2] and in_longitude_range(lon, bbox[1], bbox[3]):
+                        yield name
+            return
+
+        dlat = margin / KM_PER_DEGREE
+        coslat = cos(min(abs(lat) + dlat, 90.0) * pi / 180.0)
+        dlon = dlat / coslat if coslat > 0.0 else 180.0
+        row_min, col_min = self._cell(max(lat - dlat, -90.0), lon - dlon)
+        row_max = self._cell(min(lat + dlat, 90.0), lon)[0]
+        span = min(int(floor(2 * dlon / self.cell_size)) + 2, self.columns)
+
+        if (row_max - row_min + 1) * span > len(self.shape_cells):
+            names = set(self.shapes)
+        else:
+            names = set(self.large_shapes)
+            for row in range(row_min, row_max + 1):
+                for c in range(span):
+                    names.update(self.shape_cells.get((row, (col_min + c) % self.columns), ()))
+
+        for name in names:
+            bbox = self.shapes[name][3]
+            if bbox[0] - dlat <= lat <= bbox[2] + dlat and in_longitude_range(lon, bbox[1] - dlon, bbox[3] + dlon):
+                yield name
+
+    def candidates(self, lat, lon, radius):
+        '''
+        Get the names of all locations in grid cells overlapping the search radius,
+        and of all shapes whose bounding box contains the position.
+        @param lat: latitude in degrees
+        @param lon: longitude in degrees
+        @param radius: search radius in KM
+        '''
+        for name in self.shape_candidates(lat, lon):
+            yield name
+
+        for name in self.point_candidates(lat, lon, radius):
+            yield name
+
+    def point_candidates(self, lat, lon, radius):
+        dlat = radius / KM_PER_DEGREE
+        coslat = cos(min(abs(lat) + dlat, 90.0) * pi / 180.0)
+        row_min, col_min = self._cell(max(lat - dlat, -90.0), lon)
+        row_max = self._cell(min(lat + dlat, 90.0), lon)[0]
+
+        if coslat <= 0.0 or dlat / coslat >= 180.0:
+            span = self.columns
+        else:
+            span = int(floor(dlat / coslat / self.cell_size)) + 1
+
+        # Visiting more cells than there are occupied cells is a waste, just scan all of them.
+        if (row_max - row_min + 1) * min(2 * span + 1, self.columns) > len(self.cells):
+            for bucket in self.cells.itervalues():
+                for name in bucket:
+                    yield name
+            return
+
+        if 2 * span + 1 >= self.columns:
+            cols = range(self.columns)
+        else:
+            cols = [(col_min + c) % self.columns for c in range(-span, span + 1)]
+
+        for row in range(row_min, row_max + 1):
+            for col in cols:
+                for name in self.cells.get((row, col), ()):
+                    yield name
+
+    def distance(self, name, lat, lon):
+        '''
+        Get the distance between a position and a known location.
+        @param name: name of the location
+        @param lat: latitude in degrees
+        @param lon: longitude in degrees
+        @return: distance in KM, or None when the location is unknown
+        '''
+        entry = self.entries.get(name) or self.shapes.get(name)
+        if entry is None:
+            return None
+
+        rlat = lat * pi / 180.0
+        return haversine(rlat, lon * pi / 180.0, cos(rlat), entry[0], entry[1], entry[2])
+
+    def excess(self, name, lat, lon, radius):
+        '''
+        Get how far a position is outside the area of a location.
+        @param name: name of the location
+        @param lat: latitude in degrees
+        @param lon: longitude in degrees
+        @param radius: radius in KM for locations without their own radius or polygon
+        @return: distance in KM outside the area, negative when inside it, None for unknown locations
+        '''
+        shape = self.shapes.get(name)
+        if shape and shape[5]:
+            km = polygon_edge_distance(lat, lon, shape[5])
+            return -km if point_in_polygon(lat, lon, shape[5]) else km
+
+        km = self.distance(name, lat, lon)
+        if km is None:
+            return None
+        return km - (shape[4] if shape else radius)
+
+    def near_edge(self, lat, lon, radius, margin):
+        '''
+        Check whether a position is within a margin of the boundary of any location.
+        @param radius: radius in KM for locations without their own radius or polygon
+        @param margin: margin in KM
+        '''
+        for name in self.shape_candidates(lat, lon, margin):
+            if abs(self.excess(name, lat, lon, radius)) < margin:
+                return True
+
+        for name in self.point_candidates(lat, lon, radius + margin):
+            if abs(self.excess(name, lat, lon, radius)) < margin:
+                return True
+
+        return False
+
+    def nearest_shape(self, lat, lon):
+        '''
+        Get the shape containing the position with the nearest center.
+        @return: tuple of (name, distance to the center in KM) or None
+        '''
+        best = None
+        for name in self.shape_candidates(lat, lon):
+            if self.excess(name, lat, lon, 0) < 0:
+                km = self.distance(name, lat, lon)
+                if best is None or km < best[1]:
+                    best = (name, km)
+
+        return best
+
+    def nearest(self, lat, lon, radius):
+        '''
+        Get the nearest location containing the position.
+        @param lat: latitude in degrees
+        @param lon: longitude in degrees
+        @param radius: search radius in KM for locations without their own radius or polygon
+        @return: tuple of (name, distance in KM) or None when no location is in range
+        '''
+        rlat = lat * pi / 180.0
+        rlon = lon * pi / 180.0
+        coslat = cos(rlat)
+        best = self.nearest_shape(lat, lon)
+
+        for name in self.point_candidates(lat, lon, radius):
+            entry = self.entries[name]
+            km = haversine(rlat, rlon, coslat, entry[0], entry[1], entry[2])
+            if km < radius and (best is None or km < best[1]):
+                best = (name, km)
+
+        return best
+
+class BatchProximity():
+    '''
+    This class matches a batch of positions against all known locations at once.
+    With NumPy available the full positions x locations haversine matrix is computed
+    on contiguous float64 radian arrays, otherwise it falls back to the scalar index lookup.
+    '''
+    def __init__(self, index, chunk_size=256):
+        '''
+        @param index: the LocationIndex holding the known locations
+        @param chunk_size: maximum number of positions per distance matrix
+        '''
+        self.index = index
+        self.chunk_size = chunk_size
+        self.version = None
+
+    def _build(self):
+        names = self.index.entries.keys()
+        self.names = names
+        self.lat = numpy.array([self.index.entries[n][0] for n in names], dtype=numpy.float64)
+        self.lon = numpy.array([self.index.entries[n][1] for n in names], dtype=numpy.float64)
+        self.coslat = numpy.cos(self.lat)
+        self.version = self.index.version
+
+    def nearest(self, positions):
+        '''
+        Get the nearest location in range for a batch of positions.
+        @param positions: list of (latitude, longitude, radius) tuples, in degrees and KM
+        @return: list with a (name, distance in KM) tuple or None for each position
+        '''
+        if numpy is None or not self.index.entries:
+            return [self.index.nearest(lat, lon, radius) for lat, lon, radius in positions]
+
+        if self.version != self.index.version:
+            self._build()
+
+        result = []
+        for start in range(0, len(positions), self.chunk_size):
+            result.extend(self._nearest(positions[start:start + self.chunk_size]))
+
+        if self.index.shapes:
+            # Shapes are few and prefiltered by bounding box, test them one by one
+            for i, position in enumerate(positions):
+                shape = self.index.nearest_shape(position[0], position[1])
+                if shape and (result[i] is None or shape[1] < result[i][1]):
+                    result[i] = shape
+
+        return result
+
+    def _nearest(self, positions):
+        points = numpy.array(positions, dtype=numpy.float64).reshape(-1, 3)
+        lat = numpy.radians(points[:, 0])[:, None]
+        lon = numpy.radians(points[:, 1])[:, None]
+        radius = points[:, 2][:, None]
+
+        dlat = self.lat[None, :] - lat
+        dlon = self.lon[None, :] - lon
+        a = numpy.sin(dlat/2)**2 + numpy.cos(lat) * self.coslat[None, :] * numpy.sin(dlon/2.0)**2
+        km = EARTH_RADIUS * 2.0 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1.0-a))
+
+        km[km >= radius] = numpy.inf
+        best = km.argmin(axis=1)
+        distances = km[numpy.arange(len(best)), best]
+
+        return [(self.names[i], float(d)) if numpy.isfinite(d) else None
+                for i, d in zip(best, distances)]
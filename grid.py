@@ -0,0 +1,108 @@
+import json
+from math import ceil
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def sort_key(value):
+    '''
+    Sort numbers numerically and before text, empty values last.
+    '''
+    if value is None or value == '':
+        return (2, '')
+    number = to_number(value)
+    if number is not None:
+        return (0, number)
+    return (1, unicode(value).lower())
+
+def compare(value, op, data):
+    '''
+    Evaluate a single jqGrid search rule.
+    @param value: the value of the row
+    @param op: the jqGrid operator (eq, ne, lt, le, gt, ge, bw, bn, ew, en, cn, nc, in, ni, nu, nn)
+    @param data: the value searched for
+    '''
+    if op == 'nu':
+        return value is None or value == ''
+    elif op == 'nn':
+        return not (value is None or value == '')
+
+    if op in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+        a, b = to_number(value), to_number(data)
+        if a is None or b is None:
+            a, b = unicode(value if value is not None else '').lower(), unicode(data).lower()
+
+        if op == 'eq': return a == b
+        elif op == 'ne': return a != b
+        elif op == 'lt': return a < b
+        elif op == 'le': return a <= b
+        elif op == 'gt': return a > b
+        return a >= b
+
+    text = unicode(value if value is not None else '').lower()
+    data = unicode(data).lower()
+
+    if op == 'bw': return text.startswith(data)
+    elif op == 'bn': return not text.startswith(data)
+    elif op == 'ew': return text.endswith(data)
+    elif op == 'en': return not text.endswith(data)
+    elif op == 'cn': return data in text
+    elif op == 'nc': return data not in text
+    elif op == 'in': return text in [d.strip() for d in data.split(',')]
+    elif op == 'ni': return text not in [d.strip() for d in data.split(',')]
+
+    raise ValueError('Unknown search operator %s' % op)
+
+def matches(row, group, fields):
+    '''
+    Evaluate a jqGrid filter group, groups can be nested.
+    '''
+    rules = [compare(row.get(rule['field']), rule['op'], rule.get('data', ''))
+             for rule in group.get('rules', []) if rule.get('field') in fields]
+    rules += [matches(row, subgroup, fields) for subgroup in group.get('groups', [])]
+
+    if not rules:
+        return True
+    if group.get('groupOp', 'AND').upper() == 'OR':
+        return any(rules)
+    return all(rules)
+
+def get_page(rows, parameters, fields):
+    '''
+    Filter, sort and page rows the way jqGrid asks for them.
+    @param rows: list of (key, row) tuples, a row being a dictionary of field name to value
+    @param parameters: dictionary with the jqGrid page, rows, sidx, sord and search parameters
+    (search, searchField, searchOper, searchString and filters)
+    @param fields: the field names that may be sorted and searched on
+    @return: dictionary with page, total (number of pages), records and the keys of the rows on the page
+    '''
+    search = parameters.get('search')
+    if search:
+        filters = parameters.get('filters')
+        if filters:
+            group = json.loads(filters) if isinstance(filters, basestring) else filters
+        else:
+            group = {'groupOp': 'AND',
+                     'rules': [{'field': parameters.get('searchField'),
+                                'op': parameters.get('searchOper') or 'eq',
+                                'data': parameters.get('searchString', '')}]}
+        rows = [(key, row) for key, row in rows if matches(row, group, fields)]
+
+    sidx = parameters.get('sidx')
+    if sidx in fields:
+        rows.sort(key=lambda r: sort_key(r[1].get(sidx)), reverse=parameters.get('sord') == 'desc')
+    else:
+        rows.sort(key=lambda r: sort_key(r[0]))
+
+    size = max(int(parameters.get('rows') or 10), 1)
+    total = int(ceil(len(rows) / float(size)))
+    page = min(max(int(parameters.get('page') or 1), 1), max(total, 1))
+    start = (page - 1) * size
+
+    return {'page': page,
+            'total': total,
+            'records': len(rows),
+            'keys': [key for key, row in rows[start:start + size]]}
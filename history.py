@@ -0,0 +1,123 @@
+from twisted.enterprise import adbapi
+from twisted.internet import reactor, task, defer
+from twisted.python import log
+import time
+
+class PositionHistory():
+    '''
+    This class stores the position history of all accounts in a SQLite database.
+    Fixes are buffered in memory and inserted in batches, fixes closer together
+    than the minimum interval are dropped and old fixes are removed after the retention period.
+    '''
+    def __init__(self, filename, retention=30, min_interval=0, flush_interval=10, batch_size=500):
+        '''
+        @param filename: the SQLite database file
+        @param retention: number of days to keep fixes, 0 to keep them forever
+        @param min_interval: minimum number of seconds between stored fixes of an account
+        @param flush_interval: number of seconds between batched inserts
+        @param batch_size: number of buffered fixes that triggers an insert
+        '''
+        self.retention = retention
+        self.min_interval = min_interval
+        self.batch_size = batch_size
+        self.buffer = []
+        self.last = {}
+        self.stored = 0
+        self.dropped = 0
+
+        # A single connection, so all interactions run in order after the table is created
+        self.dbpool = adbapi.ConnectionPool('sqlite3', filename, check_same_thread=False, cp_min=1, cp_max=1)
+        self.dbpool.runInteraction(self._create).addErrback(log.err, 'Unable to create position history')
+
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(flush_interval, now=False)
+        self.expire_task = task.LoopingCall(self.expire)
+        self.expire_task.start(3600, now=True)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def _create(self, txn):
+        txn.execute('CREATE TABLE IF NOT EXISTS history (account TEXT, timestamp INTEGER, latitude REAL, longitude REAL, '
+                    'PRIMARY KEY (account, timestamp))')
+
+    def record(self, account):
+        '''
+        Buffer the current fix of an account.
+        @param account: the account holding the fix
+        '''
+        if account.timestamp is None:
+            return
+
+        last = self.last.get(account.username)
+        if last is not None and account.timestamp - last < self.min_interval * 1000:
+            self.dropped += 1
+            return
+
+        self.last[account.username] = account.timestamp
+        self.buffer.append((account.username, account.timestamp, account.latitude, account.longitude))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Insert all buffered fixes.
+        @return: a Deferred firing when the fixes are stored
+        '''
+        if not self.buffer:
+            return defer.succeed(None)
+
+        rows, self.buffer = self.buffer, []
+        d = self.dbpool.runInteraction(self._insert, rows)
+        d.addErrback(log.err, 'Unable to store position history')
+        return d
+
+    def _insert(self, txn, rows):
+        txn.executemany('INSERT OR IGNORE INTO history (account, timestamp, latitude, longitude) VALUES (?, ?, ?, ?)', rows)
+        self.stored += len(rows)
+
+    def expire(self):
+        '''
+        Remove fixes older than the retention period.
+        '''
+        if not self.retention:
+            return
+
+        cutoff = int((time.time() - self.retention * 86400) * 1000)
+        d = self.dbpool.runOperation('DELETE FROM history WHERE timestamp < ?', (cutoff,))
+        d.addErrback(log.err, 'Unable to expire position history')
+
+    @defer.inlineCallbacks
+    def query(self, account, start=0, end=None, limit=1000):
+        '''
+        Get a page of fixes for an account in a time range.
+        Pass the returned next timestamp as start to get the following page.
+        @param account: the account user name
+        @param start: start of the range in milliseconds since the epoch, inclusive
+        @param end: end of the range in milliseconds since the epoch, exclusive
+        @param limit: maximum number of fixes to return
+        @return: a Deferred firing with a dictionary holding the fixes and the next start timestamp
+        '''
+        yield self.flush()
+        if end is None:
+            end = 2**62
+
+        rows = yield self.dbpool.runQuery('SELECT timestamp, latitude, longitude FROM history '
+                                          'WHERE account = ? AND timestamp >= ? AND timestamp < ? '
+                                          'ORDER BY timestamp LIMIT ?', (account, start, end, limit + 1))
+
+        next_start = None
+        if len(rows) > limit:
+            next_start = rows[limit][0]
+            rows = rows[:limit]
+
+        defer.returnValue({'fixes': [list(row) for row in rows], 'next': next_start})
+
+    def close(self):
+        if not self.dbpool.running:
+            return defer.succeed(None)
+
+        for t in (self.flush_task, self.expire_task):
+            if t.running:
+                t.stop()
+        d = self.flush()
+        d.addBoth(lambda _: self.dbpool.close())
+        return d
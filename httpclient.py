@@ -0,0 +1,132 @@
+import cookielib
+from urlparse import urlparse
+from StringIO import StringIO
+from twisted.internet import reactor, defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.web.client import Agent, HTTPConnectionPool, ContentDecoderAgent, GzipDecoder, RedirectAgent, CookieAgent, \
+                               FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.web import error
+
+class CountingConnectionPool(HTTPConnectionPool):
+    '''
+    Connection pool that keeps track of the number of new connections made.
+    '''
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.connections_made = 0
+
+    def _newConnection(self, key, endpoint):
+        self.connections_made += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+class HTTPClient():
+    '''
+    This class performs HTTP requests over a shared pool of keep-alive connections.
+    It is a drop in replacement for twisted.web.client.getPage: redirects are followed
+    and cookies set along the way are sent on the following requests.
+    '''
+    def __init__(self, max_per_host=4, connect_timeout=30, read_timeout=60, gzip=True):
+        '''
+        @param max_per_host: maximum number of concurrent connections per host
+        @param connect_timeout: connect timeout in seconds
+        @param read_timeout: timeout in seconds for receiving the complete response
+        @param gzip: whether to ask for and decode gzip encoded responses
+        '''
+        self.pool = CountingConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_per_host
+        self.max_per_host = max_per_host
+        self.read_timeout = read_timeout
+
+        self.agent = Agent(reactor, connectTimeout=connect_timeout, pool=self.pool)
+        if gzip:
+            self.agent = ContentDecoderAgent(self.agent, [('gzip', GzipDecoder)])
+
+        self.limits = {}
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.active = 0
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def getPage(self, url, method='GET', postdata=None, headers=None):
+        '''
+        Fetch a page.
+        @param url: the URL to fetch
+        @param method: the HTTP method to use
+        @param postdata: optional request body
+        @param headers: optional dictionary of request headers
+        @return: a Deferred firing with the response body
+        '''
+        host = urlparse(url).netloc
+        if host not in self.limits:
+            self.limits[host] = defer.DeferredSemaphore(self.max_per_host)
+
+        return self.limits[host].run(self._request, url, method, postdata, headers)
+
+    @inlineCallbacks
+    def _request(self, url, method, postdata, headers):
+        self.requests += 1
+        self.active += 1
+
+        request_headers = Headers()
+        for name, value in (headers or {}).iteritems():
+            request_headers.addRawHeader(name, value)
+
+        body = None
+        if postdata is not None:
+            body = FileBodyProducer(StringIO(postdata))
+
+        # A cookie jar per request, cookies like the bridge's ACSID belong to one account
+        agent = RedirectAgent(CookieAgent(self.agent, cookielib.CookieJar()))
+        timeout = None
+        expired = []
+
+        def expire(d):
+            expired.append(True)
+            d.cancel()
+
+        try:
+            d = agent.request(method, url, request_headers, body)
+            d.addCallback(self._read)
+            timeout = reactor.callLater(self.read_timeout, expire, d)
+            result = yield d
+        except Exception:
+            self.errors += 1
+            # A cancelled request fails with ResponseNeverReceived or ResponseFailed, not CancelledError
+            if expired:
+                self.timeouts += 1
+                raise defer.TimeoutError('Request to %s timed out' % url)
+            raise
+        finally:
+            self.active -= 1
+            if timeout and timeout.active():
+                timeout.cancel()
+
+        returnValue(result)
+
+    @inlineCallbacks
+    def _read(self, response):
+        body = yield readBody(response)
+        if response.code >= 400:
+            raise error.Error(str(response.code), response.phrase, body)
+
+        returnValue(body)
+
+    def stats(self):
+        '''
+        Get connection pool statistics.
+        @return: dictionary with pool statistics
+        '''
+        return {'requests': self.requests,
+                'active': self.active,
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'connections_made': self.pool.connections_made,
+                'idle_connections': sum(len(c) for c in self.pool._connections.itervalues())}
+
+    def close(self):
+        '''
+        Close all idle connections.
+        '''
+        return self.pool.closeCachedConnections()
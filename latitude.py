@@ -1,19 +1,74 @@
 import urllib
-from twisted.web.client import getPage
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.internet import reactor, task, defer
+from twisted.internet import reactor, task, defer, stdio
+from twisted.python.failure import Failure
+from twisted.python import log
+from twisted.web import error
 from math import sin, cos, atan2, sqrt, pi
-import json, pickle
+import json
 import datetime
+import time
 from houseagent.plugins import pluginapi
 import ConfigParser
 import os
+import sys
 from houseagent import config_path
+from geoindex import LocationIndex, BatchProximity
+from geofence import GeofenceEngine
+from geocache import GeocodeCache
+from gazetteer import Gazetteer
+from httpclient import HTTPClient
+from scheduler import PollScheduler, RateLimiter
+from configstore import ConfigStore
+from history import PositionHistory
+from stats import Stats
+from grid import get_page
+from changes import ChangeLog
+from shards import ShardSupervisor, WorkerChannel, RemoteChangeLog, RemoteHistory
 
 class LatitudeWrapper():
     '''
     This is a wrapper class to handle the connection to the coordinator.
     '''
+    DEFAULTS = {'general': {'write_delay': '1'},
+                'geocode': {'precision': '7',
+                            'cache_size': '1000',
+                            'ttl': '86400',
+                            'cache_file': '',
+                            'offline_file': '',
+                            'offline_max_distance': '50',
+                            'remote': 'true'},
+                'http': {'max_per_host': '4',
+                         'connect_timeout': '30',
+                         'read_timeout': '60',
+                         'gzip': 'true'},
+                'scheduler': {'jitter': '0.1',
+                              'max_rate': '0',
+                              'batch_window': '0.05',
+                              'batch_size': '256'},
+                'adaptive': {'enabled': 'false',
+                             'min_interval': '30',
+                             'max_interval': '900',
+                             'backoff': '1.5',
+                             'speed': '20',
+                             'edge_margin': '0.2'},
+                'publish': {'heartbeat': '0'},
+                'auth': {'token_lifetime': '604800',
+                         'login_rate': '1'},
+                'history': {'enabled': 'false',
+                            'file': 'history.db',
+                            'retention': '30',
+                            'min_interval': '0',
+                            'flush_interval': '10',
+                            'batch_size': '500'},
+                'geofence': {'enabled': 'false',
+                             'enter_factor': '1.0',
+                             'exit_factor': '1.5',
+                             'dwell_time': '300'},
+                'shards': {'workers': '0',
+                           'restart_delay': '5',
+                           'balance': '1.1'}}
+    
     def __init__(self):
         callbacks = {'custom': self.cb_custom}
         self.get_configurationparameters()
@@ -21,58 +76,332 @@ class LatitudeWrapper():
                                              broker_host=self.coordinator_host, 
                                              broker_port=self.coordinator_port, **callbacks)
 
+        self.config = ConfigStore(self.config_file, delay=self.config_delay)
+        self.import_legacy_config()
+        self.login_limiter = RateLimiter(self.login_rate)
+        self.changes = ChangeLog()
         self.get_accounts()        
         self.get_locations()
-        self.latitude = Latitude(self)
+        # Workers keep their own geocode caches
+        self.start_pipeline(None if self.shards_workers else (self.geocode_cache_file or None))
+        self.history = None
+        if self.history_enabled:
+            self.history = PositionHistory(self.history_file, self.history_retention, self.history_min_interval,
+                                           self.history_flush_interval, self.history_batch_size)
+        
+        if self.shards_workers:
+            # Polling runs in worker processes, this process only talks to the coordinator
+            script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+            self.latitude = ShardSupervisor(self, self.shards_workers, script,
+                                            self.shards_restart_delay, self.shards_balance)
+        else:
+            self.latitude = Latitude(self)
 
         task.deferLater(reactor, 1.0, self.pluginapi.ready)
 
+    def import_legacy_config(self):
+        '''
+        Older versions kept accounts and locations in latitude.conf in the working directory,
+        even when the configuration directory had its own latitude.conf. Import them once.
+        '''
+        legacy = os.path.abspath('latitude.conf')
+        if legacy == os.path.abspath(self.config_file) or not os.path.exists(legacy):
+            return
+        if self.config.get('general', 'legacy_imported'):
+            return
+        
+        imported = self.config.import_sections(legacy, ('locations', 'accounts', 'tokens'))
+        if imported:
+            log.msg('Imported %s from %s' % (', '.join(imported), legacy))
+        self.config.set('general', 'legacy_imported', 'true')
+        reactor.callWhenRunning(self.config.changed)
+
+    def start_pipeline(self, cache_file):
+        '''
+        Create the geocoders and the HTTP client used by the polling pipeline.
+        @param cache_file: the geocode cache database, or None for a cache in memory only
+        '''
+        self.geocode_cache = GeocodeCache(self.geocode_precision, self.geocode_cache_size,
+                                          self.geocode_ttl, cache_file)
+        self.gazetteer = None
+        if self.geocode_offline_file:
+            self.gazetteer = Gazetteer(self.geocode_offline_file, self.geocode_offline_max_distance)
+        self.http = HTTPClient(self.http_max_per_host, self.http_connect_timeout,
+                               self.http_read_timeout, self.http_gzip)
+
     def get_configurationparameters(self):
         '''
         This function parses configuration parameters from the latitude.conf file.
         '''
         config_file = os.path.join(config_path, 'latitude', 'latitude.conf')
+        if not os.path.exists(config_file):
+            config_file = 'latitude.conf'
         
         config = ConfigParser.RawConfigParser()
-        if os.path.exists(config_file):
-            config.read(config_file)
-        else:
-            config.read('latitude.conf')
+        config.read(config_file)
+        self.config_file = config_file
         
         self.coordinator_host = config.get('coordinator', 'host')
         self.coordinator_port = config.getint('coordinator', 'port')
         self.id = config.get('general', 'id')
+        
+        # Optional settings, older configuration files may not have these
+        for section, options in self.DEFAULTS.iteritems():
+            if not config.has_section(section):
+                config.add_section(section)
+            for option, value in options.iteritems():
+                if not config.has_option(section, option):
+                    config.set(section, option, value)
+        
+        self.geocode_precision = config.getint('geocode', 'precision')
+        self.geocode_cache_size = config.getint('geocode', 'cache_size')
+        self.geocode_ttl = config.getint('geocode', 'ttl')
+        self.geocode_cache_file = config.get('geocode', 'cache_file')
+        self.geocode_offline_file = config.get('geocode', 'offline_file')
+        self.geocode_offline_max_distance = config.getfloat('geocode', 'offline_max_distance')
+        self.geocode_remote = config.getboolean('geocode', 'remote')
+        self.http_max_per_host = config.getint('http', 'max_per_host')
+        self.http_connect_timeout = config.getint('http', 'connect_timeout')
+        self.http_read_timeout = config.getint('http', 'read_timeout')
+        self.http_gzip = config.getboolean('http', 'gzip')
+        self.scheduler_jitter = config.getfloat('scheduler', 'jitter')
+        self.scheduler_max_rate = config.getfloat('scheduler', 'max_rate')
+        self.scheduler_batch_window = config.getfloat('scheduler', 'batch_window')
+        self.scheduler_batch_size = config.getint('scheduler', 'batch_size')
+        self.adaptive = config.getboolean('adaptive', 'enabled')
+        self.adaptive_min_interval = config.getfloat('adaptive', 'min_interval')
+        self.adaptive_max_interval = config.getfloat('adaptive', 'max_interval')
+        self.adaptive_backoff = config.getfloat('adaptive', 'backoff')
+        self.adaptive_speed = config.getfloat('adaptive', 'speed')
+        self.adaptive_edge_margin = config.getfloat('adaptive', 'edge_margin')
+        self.heartbeat = config.getfloat('publish', 'heartbeat')
+        self.config_delay = config.getfloat('general', 'write_delay')
+        self.token_lifetime = config.getfloat('auth', 'token_lifetime')
+        self.login_rate = config.getfloat('auth', 'login_rate')
+        self.history_enabled = config.getboolean('history', 'enabled')
+        self.history_file = config.get('history', 'file')
+        self.history_retention = config.getfloat('history', 'retention')
+        self.history_min_interval = config.getfloat('history', 'min_interval')
+        self.history_flush_interval = config.getfloat('history', 'flush_interval')
+        self.history_batch_size = config.getint('history', 'batch_size')
+        self.geofence_enabled = config.getboolean('geofence', 'enabled')
+        self.geofence_enter_factor = config.getfloat('geofence', 'enter_factor')
+        self.geofence_exit_factor = config.getfloat('geofence', 'exit_factor')
+        self.geofence_dwell_time = config.getfloat('geofence', 'dwell_time')
+        self.shards_workers = config.getint('shards', 'workers')
+        self.shards_restart_delay = config.getfloat('shards', 'restart_delay')
+        self.shards_balance = config.getfloat('shards', 'balance')
 
     def get_locations(self):
         '''
-        This function gets locations information from the Latitude configuration file.
+        This function gets locations information from the Latitude configuration store.
         '''
-        self.locations = {}
-        config = ConfigParser.RawConfigParser()
-        config.read('latitude.conf')
-        locations = config._sections['locations']
+        self.load_locations(dict(self.config.items('locations')))
+
+    def load_locations(self, locations):
+        '''
+        Replace all known locations and rebuild the location index.
+        @param locations: dictionary of location name to coordinates
+        '''
+        self.locations = locations
 
-        for key, item in locations.iteritems():
-            if key == '__name__': continue    
-            self.locations[key] = pickle.loads(item)    
+        self.location_index = LocationIndex(self.locations)
+        self.location_matcher = BatchProximity(self.location_index)
+        self.geofences = None
+        if self.geofence_enabled:
+            self.geofences = GeofenceEngine(self.location_index, self.geofence_enter_factor,
+                                            self.geofence_exit_factor, self.geofence_dwell_time)
+
+    def set_location(self, name, coordinates):
+        '''
+        Add or update a single known location.
+        @param name: the name of the location
+        @param coordinates: list of latitude, longitude and optionally a radius and polygon
+        '''
+        self.config.set('locations', name, coordinates)
+        self.locations[name] = coordinates
+        try:
+            self.location_index.set(name, coordinates)
+        except (TypeError, ValueError, IndexError):
+            self.location_index.remove(name)
+        
+        if self.shards_workers:
+            self.latitude.set_location(name, coordinates)
+
+    def remove_location(self, name):
+        '''
+        Remove a single known location.
+        @param name: the name of the location
+        '''
+        self.config.remove('locations', name)
+        self.locations.pop(name, None)
+        self.location_index.remove(name)
+        
+        if self.shards_workers:
+            self.latitude.remove_location(name)
 
     def get_accounts(self):
         '''
-        This function gets account information from the configuration file.
+        This function gets account information from the configuration store.
         '''
         self.accounts = []
-        config = ConfigParser.RawConfigParser()
-        config.read('latitude.conf')
-        accounts = config._sections['accounts']
+        self.account_names = {}
 
-        for key, item in accounts.iteritems():
-            if key == '__name__': continue
-            data = pickle.loads(item)
+        for key, data in self.config.items('accounts').iteritems():
             # Add account to list
-            acc = LatitudeAccount(key, data[1], data[0])
-            acc.refreshtime = data[2]
-            acc.proximity = data[3]
+            acc = self.create_account(key, data)
+            self.accounts.append(acc)
+            self.account_names[key] = acc
+
+    def create_account(self, name, data):
+        '''
+        Create an account object from its configuration details.
+        @param name: the account user name
+        @param data: list of device id, password, refresh time and proximity
+        '''
+        acc = LatitudeAccount(name, data[1], data[0])
+        acc.refreshtime = data[2]
+        acc.proximity = data[3]
+        acc.interval = float(acc.refreshtime)
+        
+        token = self.config.get('tokens', name)
+        if token:
+            acc.token, acc.token_time = token
+        return acc
+
+    def get_account(self, name):
+        '''
+        Get an account by user name.
+        @return: the account or None when it does not exist
+        '''
+        return self.account_names.get(name)
+
+    def set_account(self, name, data):
+        '''
+        Add or update a single account. Other accounts, and the token and
+        position of an updated account, are left alone.
+        @param name: the account user name
+        @param data: list of device id, password, refresh time and proximity
+        '''
+        self.config.set('accounts', name, data)
+        acc = self.get_account(name)
+        if not acc:
+            acc = self.create_account(name, data)
             self.accounts.append(acc)
+            self.account_names[name] = acc
+            self.latitude.add_account(acc)
+            return
+
+        if acc.password != data[1]:
+            self.set_token(acc, None)
+        acc.device_id = data[0]
+        acc.password = data[1]
+        acc.proximity = data[3]
+        if acc.refreshtime != data[2]:
+            acc.refreshtime = data[2]
+            acc.interval = float(acc.refreshtime)
+            self.latitude.add_account(acc)
+        elif self.shards_workers:
+            # The worker polling the account keeps its own copy
+            self.latitude.add_account(acc)
+
+    def set_token(self, account, token):
+        '''
+        Set and persist the authentication token of an account.
+        @param account: the account
+        @param token: the new token, or None to invalidate the current one
+        '''
+        if self.get_account(account.username) is not account:
+            # The account was removed while a login or poll was running
+            return
+        
+        account.token = token
+        account.token_time = time.time() if token else None
+        if token:
+            self.config.set('tokens', account.username, [token, account.token_time])
+        else:
+            self.config.remove('tokens', account.username)
+
+    def remove_account(self, name):
+        '''
+        Remove a single account and stop polling it.
+        @param name: the account user name
+        '''
+        self.config.remove('accounts', name)
+        self.config.remove('tokens', name)
+        acc = self.account_names.pop(name, None)
+        if acc:
+            self.accounts.remove(acc)
+            self.latitude.remove_account(acc)
+            if self.geofences:
+                self.geofences.remove(name)
+            self.changes.remove(name)
+
+    def account_details(self, acc):
+        '''
+        Get the details of an account as sent to the web interface.
+        @return: list of device id, password, refresh time, proximity, latitude, longitude, last update, effective interval and location
+        '''
+        return [acc.device_id, acc.password, acc.refreshtime, acc.proximity, acc.latitude, acc.longitude, str(acc.lastupdate), acc.interval, acc.location]
+
+    def get_locations_page(self, parameters):
+        '''
+        Get one page of known locations, filtered and sorted as requested by jqGrid.
+        @param parameters: dictionary with the jqGrid paging, sorting and search parameters
+        @return: dictionary with page, total, records and rows, a list of [name, coordinates]
+        '''
+        rows = []
+        for name, data in self.locations.iteritems():
+            rows.append((name, {'location': name,
+                                'latitude': data[0] if len(data) > 0 else '',
+                                'longitude': data[1] if len(data) > 1 else '',
+                                'radius': data[2] if len(data) > 2 else ''}))
+
+        result = get_page(rows, parameters, ('location', 'latitude', 'longitude', 'radius'))
+        result['rows'] = [[name, self.locations[name]] for name in result.pop('keys')]
+        return result
+
+    def get_accounts_page(self, parameters):
+        '''
+        Get one page of accounts, filtered and sorted as requested by jqGrid.
+        @param parameters: dictionary with the jqGrid paging, sorting and search parameters
+        @return: dictionary with page, total, records and rows, a list of [name, details]
+        '''
+        fields = ('name', 'id', 'refreshtime', 'proximity', 'latitude', 'longitude', 'updatetime', 'interval', 'location')
+        accounts = {}
+        rows = []
+        for acc in self.accounts:
+            details = self.account_details(acc)
+            accounts[acc.username] = details
+            rows.append((acc.username, dict(zip(fields, [acc.username, details[0]] + details[2:]))))
+
+        result = get_page(rows, parameters, fields)
+        result['rows'] = [[name, accounts[name]] for name in result.pop('keys')]
+        return result
+
+    @inlineCallbacks
+    def get_stats(self, accounts=True, format=None):
+        '''
+        Get the pipeline statistics together with the HTTP pool and geocode cache statistics.
+        @param accounts: whether to include per account statistics
+        @param format: None for a dictionary, 'prometheus' for the Prometheus text format
+        @return: a Deferred firing with the statistics
+        '''
+        collected = yield self.latitude.collect_stats(accounts)
+        stats = collected['stats']
+        http = collected['http']
+        cache = collected['geocode_cache']
+        
+        if format == 'prometheus':
+            extra = {'accounts': len(self.accounts), 'locations': len(self.locations)}
+            extra.update(('http_%s' % k, v) for k, v in http.iteritems())
+            extra.update(('geocode_cache_%s' % k, v) for k, v in cache.iteritems())
+            returnValue(stats.prometheus(extra))
+        
+        result = stats.snapshot(accounts)
+        result['http'] = http
+        result['geocode_cache'] = cache
+        returnValue(result)
 
     def cb_custom(self, action, parameters):
         '''
@@ -87,71 +416,59 @@ class LatitudeWrapper():
             d.callback(self.locations)
             return d
         
+        elif action == 'get_locations_page':
+            # parameters: jqGrid page, rows, sidx, sord, search, searchField, searchOper, searchString and filters
+            d = defer.Deferred()
+            d.callback(self.get_locations_page(parameters or {}))
+            return d
+        
         elif action == 'add_location':
-            config = ConfigParser.RawConfigParser()
-            config.read('latitude.conf')            
-            config.set('locations', parameters['name'], pickle.dumps(parameters['coordinates']))
-            
-            with open('latitude.conf', 'wb') as configfile:
-                config.write(configfile)
-                
-            # reload locations
-            self.get_locations()
+            self.set_location(parameters['name'], parameters['coordinates'])
             
             d = defer.Deferred()
             d.callback('OK')
             return d
         
         elif action == 'del_location':
-            config = ConfigParser.RawConfigParser()
-            config.read('latitude.conf')   
-            config.remove_option('locations', parameters)
-            
-            with open('latitude.conf', 'wb') as configfile:
-                config.write(configfile)
-                
-            # reload locations
-            self.get_locations()
+            self.remove_location(parameters)
                 
             d = defer.Deferred()
             d.callback('OK')
             return d
         
         elif action == 'edit_location':
-            config = ConfigParser.RawConfigParser()
-            config.read('latitude.conf')
-            
-            if parameters['id'] == parameters['name']:
-                config.set('locations', parameters['name'], pickle.dumps(parameters['coordinates']))
-            else:
-                # new name
-                config.remove_option('locations', parameters['id'])
-                config.set('locations', parameters['name'], pickle.dumps(parameters['coordinates']))
-                
-            with open('latitude.conf', 'wb') as configfile:
-                config.write(configfile)
-                
-            # reload locations
-            self.get_locations()
+            if parameters['id'] != parameters['name']:
+                self.remove_location(parameters['id'])
+            self.set_location(parameters['name'], parameters['coordinates'])
                 
             d = defer.Deferred()
             d.callback('OK')
             return d
         
-        # Account management
-        elif action == 'add_account':
-            config = ConfigParser.RawConfigParser()
-            config.read('latitude.conf')            
-            config.set('accounts', parameters['name'], pickle.dumps(parameters['details']))
+        elif action == 'import_locations':
+            # Bulk import of a dictionary of location name to coordinates,
+            # existing locations not in the import are removed when replace is set
+            locations = parameters['locations']
+            if parameters.get('replace'):
+                for name in self.locations.keys():
+                    if name not in locations:
+                        self.remove_location(name)
             
-            with open('latitude.conf', 'wb') as configfile:
-                config.write(configfile)
-                
-            # reload accounts
-            self.get_accounts()
+            for name, coordinates in locations.iteritems():
+                self.set_location(name, coordinates)
             
-            # restart tasks
-            self.latitude.restart_update_tasks()
+            d = defer.Deferred()
+            d.callback('OK')
+            return d
+        
+        elif action == 'export_locations':
+            d = defer.Deferred()
+            d.callback(self.locations)
+            return d
+        
+        # Account management
+        elif action == 'add_account':
+            self.set_account(parameters['name'], parameters['details'])
             
             d = defer.Deferred()
             d.callback('OK')
@@ -159,26 +476,63 @@ class LatitudeWrapper():
         elif action == 'get_accounts':
             accounts = {}
             for acc in self.accounts:
-                accounts[acc.username] = [acc.device_id, acc.password, acc.refreshtime, acc.proximity, acc.latitude, acc.longitude, str(acc.lastupdate)]
+                accounts[acc.username] = self.account_details(acc)
             d = defer.Deferred()
             d.callback(accounts)
             return d
         
+        elif action == 'get_accounts_page':
+            # parameters: jqGrid page, rows, sidx, sord, search, searchField, searchOper, searchString and filters
+            d = defer.Deferred()
+            d.callback(self.get_accounts_page(parameters or {}))
+            return d
+        
+        elif action == 'get_changes':
+            # Long poll for accounts whose position or location changed.
+            # parameters: since, the last sequence number seen (None for the current one), and timeout in seconds
+            parameters = parameters or {}
+            return self.changes.wait(parameters.get('since'), min(float(parameters.get('timeout', 20)), 60))
+        
         elif action == 'del_account':
-            config = ConfigParser.RawConfigParser()
-            config.read('latitude.conf')   
-            config.remove_option('accounts', parameters)
-            
-            with open('latitude.conf', 'wb') as configfile:
-                config.write(configfile)
-                
-            # reload accounts
-            self.get_accounts()
+            self.remove_account(parameters)
                 
             d = defer.Deferred()
             d.callback('OK')
             return d      
         
+        elif action == 'get_history':
+            # parameters: account, and optionally start, end (milliseconds since epoch) and limit
+            if not self.history:
+                return defer.fail(Exception('Position history is not enabled'))
+            
+            return self.history.query(parameters['account'], parameters.get('start', 0),
+                                      parameters.get('end'), min(int(parameters.get('limit', 1000)), 10000))
+        
+        elif action == 'get_geocode_stats':
+            d = self.latitude.collect_stats(False)
+            d.addCallback(lambda collected: collected['geocode_cache'])
+            return d
+        
+        elif action == 'get_publish_stats':
+            def publish_stats(collected):
+                counters = collected['stats'].counters
+                return {'fixes_unchanged': counters.get('fixes_unchanged', 0),
+                        'updates_sent': counters.get('updates_sent', 0),
+                        'updates_suppressed': counters.get('updates_suppressed', 0)}
+            
+            return self.latitude.collect_stats(False).addCallback(publish_stats)
+        
+        elif action == 'get_stats':
+            # parameters: optional dictionary with 'accounts' to include per account
+            # statistics and 'format' set to 'prometheus' for the text format
+            parameters = parameters or {}
+            return self.get_stats(parameters.get('accounts', True), parameters.get('format'))
+        
+        elif action == 'get_http_stats':
+            d = self.latitude.collect_stats(False)
+            d.addCallback(lambda collected: collected['http'])
+            return d
+        
 class Latitude():
     '''
     This class handles the connection to the HouseAgent Latitude service.
@@ -190,109 +544,340 @@ class Latitude():
     '''
     AUTH_URI = 'https://www.google.com/accounts/ClientLogin'
     BRIDGE_API = 'https://ha-latitude.appspot.com'
+    GEOCODE_URI = 'http://maps.google.com/maps/geo'
     APP_NAME = 'ha-latitude'
     
     def __init__(self, wrapper):
         self.wrapper = wrapper
-        self.update_tasks = []
+        self.scheduler = PollScheduler(self.poll, wrapper.scheduler_jitter, wrapper.scheduler_max_rate)
+        self.pending_matches = []
+        self.flush_call = None
+        self.inflight = SingleFlight()
+        self.stats = Stats()
         
         self.start_update_tasks()
         
     def start_update_tasks(self):
         '''
-        Start looping update tasks for each account.
+        Schedule periodic updates for each account, spread over the first refresh interval.
         '''
         for acc in self.wrapper.accounts:
-            l = task.LoopingCall(self.update, acc)
-            l.start(float(acc.refreshtime))
-            self.update_tasks.append(l)
+            self.add_account(acc)
         
-    def restart_update_tasks(self):
+        self.scheduler.start()
+        
+    def add_account(self, account):
         '''
-        Trigger a restart of update tasks.
+        Start, or restart, periodic updates for a single account.
+        @param account: the account to poll
         '''
-        for t in self.update_tasks:
-            t.stop()
+        self.scheduler.add(account.username, account, account.interval or float(account.refreshtime))
         
-        self.start_update_tasks()
+    def remove_account(self, account):
+        '''
+        Stop periodic updates for a single account.
+        @param account: the account to stop polling
+        '''
+        self.scheduler.remove(account.username)
+        self.stats.remove_account(account.username)
+        
+    def collect_stats(self, accounts=True):
+        '''
+        Get the pipeline, HTTP pool and geocode cache statistics.
+        @return: a Deferred firing with a dictionary with the stats, http and geocode_cache statistics
+        '''
+        return defer.succeed({'stats': self.stats,
+                              'http': self.wrapper.http.stats(),
+                              'geocode_cache': self.wrapper.geocode_cache.stats()})
+        
+    def poll(self, account):
+        '''
+        Periodic update entry point, errors are logged so polling continues.
+        @param account: the account to update
+        '''
+        d = self.stats.measure('update', self.update(account), account.username)
+        d.addErrback(log.err, 'Latitude update failed for %s' % account.username)
             
     def update(self, account):
         '''
         Update the Latitude location information for a specific account.
         @param account: the account used to update the location information.
+        @return: a Deferred shared with any update still running for the same account
         '''
-        if not account.token:
-            self.get_token(account)
+        return self.inflight.run(('update', account.username), self._update, account)
+    
+    def _update(self, account):
+        lifetime = self.wrapper.token_lifetime
+        if not account.token or (lifetime and time.time() - account.token_time > lifetime):
+            return self.get_token(account)
         else:
-            self.get_latitudedata(account)
+            return self.get_latitudedata(account)
 
     @inlineCallbacks
     def get_token(self, account):
         '''
         Get an authentication token for the specified account.
+        Logins are rate limited across all accounts.
         @param account: the account to get the token for
         '''
+        yield self.wrapper.login_limiter.acquire()
+        
         authreq_data = urllib.urlencode({ "Email":   account.username,
                                           "Passwd":  account.password,
                                           "service": "ah",
                                           "source":  self.APP_NAME,
                                           "accountType": "HOSTED_OR_GOOGLE" })
 
-        response = yield getPage(self.AUTH_URI, method='POST', 
+        self.stats.increment('logins')
+        response = yield self.stats.measure('token', self.wrapper.http.getPage(self.AUTH_URI, method='POST', 
                     postdata=authreq_data, 
-                    headers={'Content-Type': 'application/x-www-form-urlencoded'})
+                    headers={'Content-Type': 'application/x-www-form-urlencoded'}), account.username)
         
-        auth_resp_dict = dict(x.split("=")
+        auth_resp_dict = dict(x.split("=", 1)
                       for x in response.split("\n") if x)
-        account.token = auth_resp_dict["Auth"]
-        self.get_latitudedata(account)
+        self.wrapper.set_token(account, auth_resp_dict["Auth"])
+        yield self.get_latitudedata(account, reauthenticate=False)
         
     @inlineCallbacks
-    def get_latitudedata(self, account):               
+    def get_latitudedata(self, account, reauthenticate=True):               
         '''
         Get current latitude data for the specified account.
+        When the bridge rejects the token the account logs in again, once.
         @param account: the account to get infromation for
+        @param reauthenticate: whether to get a new token when the current one is rejected
         '''
         serv_args = {}
         serv_args['continue'] = self.BRIDGE_API
         serv_args['auth']     = account.token
-        response = yield getPage('%s/_ah/login?%s' % (self.BRIDGE_API, urllib.urlencode(serv_args)))
-
+        username = account.username
         try:
+            response = yield self.stats.measure('bridge', self.wrapper.http.getPage('%s/_ah/login?%s' % (self.BRIDGE_API, urllib.urlencode(serv_args))), username)
+            # The bridge answers with a login page instead of JSON when the token is not accepted
+            start = time.time()
             response = json.loads(response)
+        except (error.Error, ValueError), e:
+            if isinstance(e, error.Error) and e.status not in ('401', '403'):
+                raise
+            if self.removed(account):
+                return
+            
+            self.stats.increment('auth_failures')
+            self.wrapper.set_token(account, None)
+            if not reauthenticate:
+                raise AuthenticationError('Bridge rejected the token of %s' % account.username)
+            
+            yield self.get_token(account)
+            return
+        
+        if self.removed(account):
+            return
+        
+        previous = account.latitude, account.longitude, account.timestamp
+
+        try:
             account.latitude = response['data']['latitude']
             account.longitude = response['data']['longitude']
-            account.lastupdate = datetime.datetime.fromtimestamp(int(response['data']['timestampMs']) //1000)
-        except:
-            pass
+            account.timestamp = int(response['data']['timestampMs'])
+            account.lastupdate = datetime.datetime.fromtimestamp(account.timestamp //1000)
+        except (KeyError, TypeError, ValueError), e:
+            # Keep the previous position
+            self.stats.error('parse', username)
+            log.msg('Unexpected bridge response for %s: %r' % (username, e))
+        else:
+            self.stats.observe('parse', time.time() - start, username)
        
         if account.latitude and account.longitude:
-            location = None
+            if self.wrapper.adaptive:
+                self.adapt_interval(account, previous)
             
-            for loc, data in self.wrapper.locations.iteritems():
-                loc1 = account.latitude, account.longitude
-                loc2 = float(data[0]), float(data[1])
-
-                if self.get_distance_by_haversine(loc1, loc2) < float(account.proximity):
-                    location = loc
-                    break
+            if self.wrapper.geofences:
+                start = time.time()
+                inside = self.update_geofences(account)
+                self.stats.observe('match', time.time() - start, username)
+            
+            if (account.latitude, account.longitude, account.timestamp) == previous and \
+               account.location_version == self.wrapper.location_index.version:
+                # Same fix as last time, the resolved location can not have changed
+                self.stats.increment('fixes_unchanged')
+                location = account.location
+            else:
+                if self.wrapper.history:
+                    self.wrapper.history.record(account)
+                
+                location = None
                 
-            if not location:
-                location = yield self.reverse_geocode(account)
+                if self.wrapper.geofences:
+                    location = inside
+                else:
+                    match = yield self.stats.measure('match', self.match_location(account), username)
+                    if match:
+                        location = match[0]
+                    
+                if not location:
+                    location = yield self.stats.measure('geocode', self.reverse_geocode(account), username)
+                
+                account.location_version = self.wrapper.location_index.version
 
-            values = {'Current location': location}
+            if self.removed(account):
+                return
+            
+            previous_location = account.location
+            self.publish(account, location)
+            
+            if (account.latitude, account.longitude, account.timestamp) != previous or account.location != previous_location:
+                # Feeds the live account updates of the web interface
+                self.wrapper.changes.record(account.username, self.wrapper.account_details(account))
+    
+    def removed(self, account):
+        '''
+        Check whether an account was removed, or replaced, while an update of it was running.
+        '''
+        return self.wrapper.get_account(account.username) is not account
+    
+    def update_geofences(self, account):
+        '''
+        Update the geofence state of an account and publish enter, exit and dwell events.
+        @param account: the account with the current fix
+        @return: the nearest location the account is in, or None
+        '''
+        events, inside = self.wrapper.geofences.update(account, reactor.seconds())
+        
+        for event, location in events:
+            values = {'Geofence event': event, 'Geofence': location}
             self.wrapper.pluginapi.value_update(account.username, values)
+        
+        return inside
+    
+    def publish(self, account, location):
+        '''
+        Publish the current location of an account to the coordinator.
+        Nothing is sent when the location did not change, unless the heartbeat interval has passed.
+        @param account: the account to publish the location for
+        @param location: the resolved location
+        '''
+        now = reactor.seconds()
+        heartbeat = self.wrapper.heartbeat
+        
+        if location == account.location and not (heartbeat and now - account.published >= heartbeat):
+            self.stats.increment('updates_suppressed')
+            return
+        
+        account.location = location
+        account.published = now
+        self.stats.increment('updates_sent')
+        
+        start = time.time()
+        values = {'Current location': location}
+        self.wrapper.pluginapi.value_update(account.username, values)
+        self.stats.observe('publish', time.time() - start, account.username)
+    
+    def adapt_interval(self, account, previous):
+        '''
+        Adjust the poll interval of an account to its movement.
+        The interval backs off while successive fixes stay within the account proximity
+        and drops to the minimum when moving fast or close to the edge of a known location.
+        @param account: the account with the current fix
+        @param previous: tuple of latitude, longitude and timestampMs of the previous fix
+        '''
+        wrapper = self.wrapper
+        proximity = float(account.proximity)
+        interval = float(account.refreshtime)
+        
+        if previous[0] is not None and previous[1] is not None:
+            moved = self.get_distance_by_haversine(previous[:2], (account.latitude, account.longitude))
+            
+            if previous[2] and account.timestamp > previous[2]:
+                account.speed = moved / ((account.timestamp - previous[2]) / 3600000.0)
+            elif moved == 0:
+                account.speed = 0.0
+            
+            near_edge = wrapper.location_index.near_edge(account.latitude, account.longitude, 
+                                                         proximity, wrapper.adaptive_edge_margin)
+            
+            if account.speed >= wrapper.adaptive_speed or near_edge:
+                interval = wrapper.adaptive_min_interval
+            elif moved < proximity:
+                interval = min(wrapper.adaptive_max_interval, max(account.interval, interval) * wrapper.adaptive_backoff)
+        
+        account.interval = interval
+        self.scheduler.set_interval(account.username, interval)
+        
+    def match_location(self, account):
+        '''
+        Queue an account position for matching against the known locations.
+        Bridge responses arrive spread out, so positions are collected for the batch window
+        and matched in one batch, or sooner when the batch is full.
+        @param account: the account to match
+        @return: a Deferred firing with a (location, distance in KM) tuple or None
+        '''
+        d = defer.Deferred()
+        try:
+            position = (account.latitude, account.longitude, float(account.proximity))
+        except (TypeError, ValueError):
+            d.errback()
+            return d
+        
+        if not self.pending_matches:
+            self.flush_call = reactor.callLater(self.wrapper.scheduler_batch_window, self.flush_matches)
+        
+        self.pending_matches.append((position, d))
+        if len(self.pending_matches) >= self.wrapper.scheduler_batch_size:
+            self.flush_call.cancel()
+            self.flush_matches()
+        return d
+    
+    def flush_matches(self):
+        '''
+        Match all queued account positions against the known locations in one batch.
+        '''
+        pending, self.pending_matches = self.pending_matches, []
+        try:
+            matches = self.wrapper.location_matcher.nearest([position for position, _ in pending])
+        except Exception:
+            failure = Failure()
+            for _, d in pending:
+                d.errback(failure)
+            return
+
+        for (_, d), match in zip(pending, matches):
+            d.callback(match)
     
-    @inlineCallbacks
     def reverse_geocode(self, account):
         '''
         This function is used to get reverse geocode information for an unknown address.
+        With an offline gazetteer configured the nearest place is used, the remote
+        geocoder is only asked when no place is near enough and remote lookups are enabled.
+        Concurrent lookups for the same cached position share a single request.
         @param account: the account to get the reverse geocode information for
         '''
-        geocode_url = 'http://maps.google.com/maps/geo?q=%s,%s6&output=json' % (account.latitude, account.longitude)
-        response = yield getPage(geocode_url)
+        if self.wrapper.gazetteer:
+            place = self.wrapper.gazetteer.nearest(account.latitude, account.longitude)
+            if place:
+                return defer.succeed(place[0])
+        
+        if not self.wrapper.geocode_remote:
+            return defer.succeed('%s, %s' % (account.latitude, account.longitude))
+        
+        cache = self.wrapper.geocode_cache
+        location = cache.get(account.latitude, account.longitude)
+        if location:
+            return defer.succeed(location)
+        
+        key = cache.key(account.latitude, account.longitude)
+        return self.inflight.run(('geocode', key), self.fetch_geocode, account.latitude, account.longitude)
+    
+    @inlineCallbacks
+    def fetch_geocode(self, latitude, longitude):
+        '''
+        Fetch reverse geocode information from the geocoder and store it in the cache.
+        @param latitude: latitude of the position to look up
+        @param longitude: longitude of the position to look up
+        '''
+        geocode_url = '%s?q=%s,%s6&output=json' % (self.GEOCODE_URI, latitude, longitude)
+        response = yield self.wrapper.http.getPage(geocode_url)
         response = json.loads(response)
         location = response['Placemark'][0]['address']
+        self.wrapper.geocode_cache.put(latitude, longitude, location)
         
         returnValue(location)
         
@@ -325,6 +910,45 @@ class Latitude():
         km = 6371.0 * c
         return km
     
+class AuthenticationError(Exception):
+    '''
+    Raised when an account can not be authenticated with the Latitude bridge.
+    '''
+
+class SingleFlight():
+    '''
+    This class makes sure only one call per key is running at a time.
+    Callers asking for a key that is already in flight get a Deferred
+    that fires with the result of the running call.
+    '''
+    def __init__(self):
+        self.pending = {}
+        
+    def run(self, key, f, *args, **kwargs):
+        '''
+        Run a function unless a call for the same key is already running.
+        @param key: the key identifying the call
+        @param f: the function to run, may return a Deferred
+        @return: a Deferred firing with the result of the (shared) call
+        '''
+        if key in self.pending:
+            d = defer.Deferred()
+            self.pending[key].append(d)
+            return d
+        
+        waiters = self.pending[key] = []
+        
+        def done(result):
+            del self.pending[key]
+            for d in waiters:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+            return result
+        
+        return defer.maybeDeferred(f, *args, **kwargs).addBoth(done)
+
 class LatitudeAccount():
     '''
     This is a skeleton class to hold all the information about a Latitude account.
@@ -339,6 +963,13 @@ class LatitudeAccount():
         self.refreshtime = None
         self.proximity = None
         self.device_id = device_id
+        self.timestamp = None
+        self.token_time = None
+        self.interval = None
+        self.speed = 0.0
+        self.location = None
+        self.location_version = None
+        self.published = 0
         
     def __str__(self):
         return 'Account: {0}, Latitude: {1}, Longitude: {2}, Last update: {3}'.format(self.username,
@@ -346,6 +977,116 @@ class LatitudeAccount():
                                                                                       self.longitude,
                                                                                       self.lastupdate)
 
+class LatitudeWorker(LatitudeWrapper):
+    '''
+    This class runs the polling pipeline for one shard of the accounts, in a process
+    started by the ShardSupervisor. Accounts and locations come from the supervisor,
+    and value updates, tokens, changes and fixes are sent back to it.
+    '''
+    def __init__(self, shard, shards):
+        '''
+        @param shard: the index of this shard
+        @param shards: the number of shards
+        '''
+        self.shard = shard
+        self.get_configurationparameters()
+        self.shards_workers = 0
+        # Rate limits are shared by all shards
+        self.scheduler_max_rate /= shards
+        self.login_limiter = RateLimiter(self.login_rate / shards)
+        
+        self.channel = WorkerChannel(self.cb_message)
+        self.pluginapi = self.channel
+        self.changes = RemoteChangeLog(self.channel, self)
+        self.config = None
+        self.accounts = []
+        self.account_names = {}
+        self.load_locations({})
+        cache_file = None
+        if self.geocode_cache_file:
+            cache_file = '%s.%d' % (self.geocode_cache_file, shard)
+        self.start_pipeline(cache_file)
+        self.history = None
+        if self.history_enabled:
+            self.history = RemoteHistory(self.channel)
+        self.latitude = Latitude(self)
+        
+        stdio.StandardIO(self.channel)
+
+    def set_token(self, account, token):
+        if self.get_account(account.username) is not account:
+            return
+        
+        account.token = token
+        account.token_time = time.time() if token else None
+        self.channel.send('token', name=account.username, token=token)
+
+    def put_account(self, name, details, token, token_time, state):
+        '''
+        Add or update an account sent by the supervisor.
+        @param state: the last known position, location and poll interval, kept when an account moves between shards
+        '''
+        acc = self.get_account(name)
+        if not acc:
+            acc = LatitudeAccount(name, details[1], details[0])
+            acc.refreshtime = details[2]
+            acc.latitude, acc.longitude, acc.location = state['latitude'], state['longitude'], state['location']
+            acc.timestamp = state['timestamp']
+            if acc.timestamp:
+                acc.lastupdate = datetime.datetime.fromtimestamp(acc.timestamp // 1000)
+            acc.interval = state['interval'] or float(acc.refreshtime)
+            self.accounts.append(acc)
+            self.account_names[name] = acc
+        elif acc.refreshtime != details[2]:
+            acc.refreshtime = details[2]
+            acc.interval = float(acc.refreshtime)
+        
+        acc.device_id = details[0]
+        acc.password = details[1]
+        acc.proximity = details[3]
+        acc.token, acc.token_time = token, token_time
+        self.latitude.add_account(acc)
+
+    def drop_account(self, name):
+        acc = self.account_names.pop(name, None)
+        if acc:
+            self.accounts.remove(acc)
+            self.latitude.remove_account(acc)
+            if self.geofences:
+                self.geofences.remove(name)
+
+    def cb_message(self, message):
+        '''
+        Handle a message of the supervisor.
+        '''
+        type = message['type']
+        
+        if type == 'locations':
+            self.load_locations(message['locations'])
+        elif type == 'location':
+            self.locations[message['name']] = message['coordinates']
+            try:
+                self.location_index.set(message['name'], message['coordinates'])
+            except (TypeError, ValueError, IndexError):
+                self.location_index.remove(message['name'])
+        elif type == 'del_location':
+            self.locations.pop(message['name'], None)
+            self.location_index.remove(message['name'])
+        elif type == 'account':
+            self.put_account(message['name'], message['details'], message['token'], message['token_time'], message['state'])
+        elif type == 'del_account':
+            self.drop_account(message['name'])
+        elif type == 'stats':
+            result = {'stats': self.latitude.stats.snapshot(message['accounts']),
+                      'http': self.http.stats(),
+                      'geocode_cache': self.geocode_cache.stats()}
+            self.channel.send('reply', id=message['id'], result=result)
+
 if __name__ == '__main__':
-    wrapper = LatitudeWrapper()
+    if len(sys.argv) == 4 and sys.argv[1] == '--shard':
+        # Standard output carries the messages to the supervisor
+        log.startLogging(sys.stderr)
+        worker = LatitudeWorker(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        wrapper = LatitudeWrapper()
     reactor.run()
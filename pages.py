@@ -5,23 +5,82 @@ from mako.lookup import TemplateLookup
 from mako.template import Template
 from twisted.web.static import File
 import os
-from twisted.internet.defer import inlineCallbacks
+import shutil
+import tempfile
+from twisted.internet.defer import inlineCallbacks, succeed, gatherResults
+from twisted.internet import reactor, task
+
+# Compiled templates are kept in memory and as modules on disk, so they are only compiled once.
+# The modules are imported, so they go in a directory only this process can write to.
+TEMPLATE_MODULES = tempfile.mkdtemp(prefix='houseagent_latitude_templates_')
+reactor.addSystemEventTrigger('after', 'shutdown', shutil.rmtree, TEMPLATE_MODULES, True)
+template_lookup = TemplateLookup(directories=['houseagent/templates/'], module_directory=TEMPLATE_MODULES)
+templates = {}
+
+def get_template(name):
+    '''
+    Get a compiled latitude template.
+    @param name: file name of the template in the latitude templates directory
+    '''
+    if name not in templates:
+        templates[name] = Template(filename='houseagent/plugins/latitude/templates/%s' % name, 
+                                   lookup=template_lookup, module_directory=TEMPLATE_MODULES)
+    return templates[name]
+
+def query_device_names(db, ids, chunk_size=500):
+    '''
+    Get the names of many devices using one query per chunk of ids,
+    instead of one query per device.
+    The HouseAgent database class has no bulk lookup, so this queries the devices
+    table through its connection pool directly.
+    @param db: the HouseAgent database
+    @param ids: the device ids
+    @return: a Deferred firing with a dictionary of device id to device name
+    '''
+    ids = list(set(ids))
+    if not ids:
+        return succeed({})
+    
+    queries = []
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        queries.append(db.dbpool.runQuery('SELECT id, name FROM devices WHERE id IN (%s)' % ','.join('?' * len(chunk)), chunk))
+    
+    d = gatherResults(queries)
+    d.addCallback(lambda results: dict((row[0], row[1]) for rows in results for row in rows))
+    return d
+
+def grid_parameters(request):
+    '''
+    Get the paging, sorting and search parameters jqGrid sends with a data request.
+    '''
+    parameters = {'search': request.args.get('_search', ['false'])[0] == 'true'}
+    for name in ('page', 'rows', 'sidx', 'sord', 'searchField', 'searchOper', 'searchString', 'filters'):
+        if name in request.args:
+            parameters[name] = request.args[name][0]
+    return parameters
+
+def grid_result(result, rows):
+    return json.dumps({'page': result['page'],
+                       'total': result['total'],
+                       'records': result['records'],
+                       'rows': rows})
 
 def init_pages(web, coordinator, db):
     web.putChild('latitude_accounts', Latitude_accounts())
     web.putChild('latitude_account', Latitude_account(coordinator, db))
     web.putChild('latitude_accounts_data', Latitude_accounts_data(coordinator, db))
+    web.putChild('latitude_accounts_stream', Latitude_accounts_stream(coordinator))
     web.putChild('latitude_locations_data', Latitude_locations_data(coordinator, db))
     web.putChild('latitude_locations', Latitude_locations())
     web.putChild('latitude_location', Latitude_location(coordinator))
+    web.putChild('latitude_stats', Latitude_stats())
+    web.putChild('latitude_stats_data', Latitude_stats_data(coordinator))
     web.putChild("latitude_images", File(os.path.join('houseagent/plugins/latitude/templates/images')))
     
 class Latitude_accounts(Resource):
     def render_GET(self, request):
-        lookup = TemplateLookup(directories=['houseagent/templates/'])
-        template = Template(filename='houseagent/plugins/latitude/templates/accounts.html', lookup=lookup)
-        
-        return str(template.render())  
+        return str(get_template('accounts.html').render())  
     
 class Latitude_account(Resource):
     
@@ -74,44 +133,152 @@ class Latitude_accounts_data(Resource):
         self.db = db
     
     @inlineCallbacks
-    def result(self, result):
+    def result(self, result, request):
+        device_names = yield query_device_names(self.db, [data[0] for account, data in result['rows']])
+        
         output = []
-        for account, data in result.iteritems():
-            device_name = yield self.db.query_device(data[0])
-            
+        for account, data in result['rows']:
             acc = {'name': account,
-                   'device_name': device_name[0][1],
+                   'device_name': device_names.get(data[0]),
                    'id': data[0],
                    'password': data[1],
                    'refreshtime': data[2],
                    'proximity': data[3],
                    'latitude': data[4],
                    'longitude': data[5],
-                   'updatetime': data[6]}
+                   'updatetime': data[6],
+                   'interval': data[7],
+                   'location': data[8]}
             output.append(acc)
             
-        self.request.write(json.dumps(output))
-        self.request.finish()
+        request.write(grid_result(result, output))
+        request.finish()
     
     def render_GET(self, request):
-        self.request = request
         plugins = self.coordinator.get_plugins_by_type("Latitude")
         
         if len(plugins) == 0:
-            self.request.write(str("No online latitude plugins found..."))
-            self.request.finish()
+            request.write(str("No online latitude plugins found..."))
+            request.finish()
         elif len(plugins) == 1:
             self.pluginguid = plugins[0].guid
             self.pluginid = plugins[0].id
-            self.coordinator.send_custom(plugins[0].guid, "get_accounts", '').addCallback(self.result)   
+            self.coordinator.send_custom(plugins[0].guid, "get_accounts_page", grid_parameters(request)).addCallback(self.result, request)   
                 
         return NOT_DONE_YET
     
+class Latitude_accounts_stream(Resource):
+    '''
+    Server-Sent Events stream of the accounts whose position or location changed.
+    All connected browsers share one long poll to the plugin, which only returns when something changed.
+    '''
+    isLeaf = True
+    
+    def __init__(self, coordinator, timeout=20, retry=5):
+        '''
+        @param coordinator: the coordinator
+        @param timeout: number of seconds the plugin holds a long poll
+        @param retry: number of seconds to wait when no plugin is available or the long poll failed
+        '''
+        Resource.__init__(self)
+        self.coordinator = coordinator
+        self.timeout = timeout
+        self.retry = retry
+        self.clients = set()
+        self.seq = None
+        self.polling = False
+    
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+        request.write('retry: %d\n\n' % (self.retry * 1000))
+        
+        self.clients.add(request)
+        request.notifyFinish().addBoth(lambda _: self.clients.discard(request))
+        
+        if not self.polling:
+            self.poll()
+        return NOT_DONE_YET
+    
+    def send(self, data):
+        for request in list(self.clients):
+            request.write(data)
+    
+    def event(self, name, data):
+        changes = {}
+        for account, details in data['changes'].iteritems():
+            # None for removed accounts
+            if details is not None:
+                details = {'latitude': details[4],
+                           'longitude': details[5],
+                           'updatetime': details[6],
+                           'interval': details[7],
+                           'location': details[8]}
+            changes[account] = details
+        
+        return 'id: %d\nevent: %s\ndata: %s\n\n' % (data['seq'], name, json.dumps(changes))
+    
+    @inlineCallbacks
+    def poll(self):
+        self.polling = True
+        try:
+            while self.clients:
+                plugins = self.coordinator.get_plugins_by_type("Latitude")
+                if len(plugins) != 1:
+                    self.seq = None
+                    yield task.deferLater(reactor, self.retry, lambda: None)
+                    continue
+                
+                try:
+                    result = yield self.coordinator.send_custom(plugins[0].guid, "get_changes", 
+                                                                {'since': self.seq, 'timeout': self.timeout})
+                except Exception:
+                    # The plugin may have restarted, start again from its current sequence number
+                    self.seq = None
+                    yield task.deferLater(reactor, self.retry, lambda: None)
+                    continue
+                
+                if result['changes']:
+                    self.send(self.event('accounts', result))
+                else:
+                    # Keeps proxies from closing an idle stream
+                    self.send(': keepalive\n\n')
+                self.seq = result['seq']
+        finally:
+            self.polling = False
+    
+def parse_polygon(text):
+    '''
+    Parse a polygon entered as "latitude,longitude; latitude,longitude; ..."
+    @return: list of [latitude, longitude] vertices, or None for an empty string
+    '''
+    vertices = [v.split(',') for v in text.split(';') if v.strip()]
+    if not vertices:
+        return None
+    return [[float(v[0]), float(v[1])] for v in vertices]
+
+def format_polygon(polygon):
+    if not polygon:
+        return ''
+    return '; '.join('%s,%s' % (v[0], v[1]) for v in polygon)
+
 class Latitude_location(Resource):
     
     def __init__(self, coordinator):
         self.coordinator = coordinator
         
+    def coordinates(self, request):
+        latitude = request.args['latitude'][0]
+        longitude = request.args['longitude'][0]
+        radius = request.args.get('radius', [''])[0]
+        polygon = parse_polygon(request.args.get('polygon', [''])[0])
+        
+        if polygon:
+            return [latitude, longitude, radius, polygon]
+        elif radius:
+            return [latitude, longitude, radius]
+        return [latitude, longitude]
+        
     def result(self, result):
         self.request.write("OK")
         self.request.finish()
@@ -129,58 +296,85 @@ class Latitude_location(Resource):
             pluginguid = plugins[0].guid    
         
         if operation == 'add':
-            latitude = request.args['latitude'][0]
-            longitude = request.args['longitude'][0]
             location = request.args['location'][0]
             
-            data = {'name': location, 'coordinates': [latitude, longitude]}
+            data = {'name': location, 'coordinates': self.coordinates(request)}
             self.coordinator.send_custom(pluginguid, 'add_location', data).addCallback(self.result)
         elif operation == 'del':
             name = request.args['id'][0]
             self.coordinator.send_custom(pluginguid, 'del_location', name).addCallback(self.result)
         elif operation == 'edit':
-            latitude = request.args['latitude'][0]
-            longitude = request.args['longitude'][0]
             location = request.args['location'][0]
             id = request.args['id'][0]
             
-            data = {'name': location, 'coordinates': [latitude, longitude], 'id': id}
+            data = {'name': location, 'coordinates': self.coordinates(request), 'id': id}
             self.coordinator.send_custom(pluginguid, 'edit_location', data).addCallback(self.result)
                 
         return NOT_DONE_YET
 
 class Latitude_locations(Resource):
     def render_GET(self, request):
-        lookup = TemplateLookup(directories=['houseagent/templates/'])
-        template = Template(filename='houseagent/plugins/latitude/templates/locations.html', lookup=lookup)
-        
-        return str(template.render())
+        return str(get_template('locations.html').render())
     
 class Latitude_locations_data(Resource):
     def __init__(self, coordinator, db):
         self.coordinator = coordinator
         
-    def result(self, result):
+    def result(self, result, request):
         output = []
-        for location, data in result.iteritems():
+        for location, data in result['rows']:
             loc = {'location': location,
                    'latitude': data[0],
-                   'longitude': data[1]}
+                   'longitude': data[1],
+                   'radius': data[2] if len(data) > 2 else '',
+                   'polygon': format_polygon(data[3] if len(data) > 3 else None)}
             output.append(loc)
             
-        self.request.write(json.dumps(output))
-        self.request.finish()
+        request.write(grid_result(result, output))
+        request.finish()
     
     def render_GET(self, request):
-        self.request = request
         plugins = self.coordinator.get_plugins_by_type("Latitude")
         
         if len(plugins) == 0:
-            self.request.write(str("No online latitude plugins found..."))
-            self.request.finish()
+            request.write(str("No online latitude plugins found..."))
+            request.finish()
         elif len(plugins) == 1:
             self.pluginguid = plugins[0].guid
             self.pluginid = plugins[0].id
-            self.coordinator.send_custom(plugins[0].guid, "get_locations", '').addCallback(self.result)   
+            self.coordinator.send_custom(plugins[0].guid, "get_locations_page", grid_parameters(request)).addCallback(self.result, request)   
                 
-        return NOT_DONE_YET
\ No newline at end of file
+        return NOT_DONE_YET
+
+class Latitude_stats(Resource):
+    def render_GET(self, request):
+        return str(get_template('stats.html').render())
+
+class Latitude_stats_data(Resource):
+    '''
+    Pipeline statistics as JSON, or in the Prometheus text format with ?format=prometheus
+    '''
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+        
+    def result(self, result, request, format):
+        if format == 'prometheus':
+            request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+            request.write(str(result))
+        else:
+            request.write(json.dumps(result))
+        request.finish()
+    
+    def render_GET(self, request):
+        plugins = self.coordinator.get_plugins_by_type("Latitude")
+        format = request.args.get('format', [None])[0]
+        accounts = request.args.get('accounts', ['1'])[0] != '0'
+        
+        if len(plugins) == 0:
+            request.write(str("No online latitude plugins found..."))
+            request.finish()
+        elif len(plugins) == 1:
+            parameters = {'accounts': accounts, 'format': format}
+            self.coordinator.send_custom(plugins[0].guid, "get_stats", parameters).addCallback(self.result, request, format)
+                
+        return NOT_DONE_YET
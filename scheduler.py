@@ -0,0 +1,191 @@
+import heapq
+import itertools
+import random
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+
+class PollScheduler():
+    '''
+    This class schedules periodic polls for many items using a single timer.
+    Due times are kept in a heap, initial polls are spread over the first interval,
+    every interval gets some random jitter and an optional global cap on polls per second is enforced.
+    The cap delays polls, so a warning is logged when the intervals ask for more polls than it allows.
+    '''
+    def __init__(self, callback, jitter=0.1, max_rate=0, clock=reactor):
+        '''
+        @param callback: function called with the payload of every item that is due
+        @param jitter: maximum random deviation of each interval, as a fraction of it
+        @param max_rate: maximum number of polls per second, 0 to disable
+        @param clock: the reactor used for timing
+        '''
+        self.callback = callback
+        self.jitter = jitter
+        self.max_rate = max_rate
+        self.clock = clock
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.timer = None
+        self.running = False
+        self.tokens = max(1.0, max_rate)
+        self.last_refill = clock.seconds()
+        self.demand = 0.0
+        self.over_rate = False
+
+    def add(self, key, payload, interval, stagger=True):
+        '''
+        Add an item to the schedule, replacing any existing item with the same key.
+        @param key: unique key of the item
+        @param payload: value passed to the callback
+        @param interval: poll interval in seconds
+        @param stagger: spread the first poll randomly over the first interval
+        '''
+        self.remove(key)
+
+        delay = random.uniform(0, interval) if stagger else 0
+        entry = [self.clock.seconds() + delay, next(self.counter), key, payload, float(interval)]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        self._add_demand(interval)
+        self._wakeup()
+
+    def remove(self, key):
+        '''
+        Remove an item from the schedule.
+        @param key: the key of the item to remove
+        '''
+        entry = self.entries.pop(key, None)
+        if entry:
+            # Lazy deletion, the heap entry is skipped when it comes up
+            entry[2] = None
+            self._add_demand(entry[4], -1)
+
+    def set_interval(self, key, interval):
+        '''
+        Change the poll interval of an item, the next poll is moved forward when needed.
+        @param key: the key of the item
+        @param interval: the new interval in seconds
+        '''
+        entry = self.entries.get(key)
+        if not entry or entry[4] == interval:
+            return
+
+        old = entry[4]
+        entry[4] = float(interval)
+        self._add_demand(old, -1)
+        self._add_demand(interval)
+        due = entry[0] - old + interval
+        if due < entry[0]:
+            self.reschedule(key, max(due, self.clock.seconds()))
+
+    def reschedule(self, key, due):
+        '''
+        Move the next poll of an item to a specific time.
+        @param key: the key of the item
+        @param due: the time of the next poll
+        '''
+        entry = self.entries[key]
+        entry[2] = None
+        entry = [due, next(self.counter), key, entry[3], entry[4]]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        self._wakeup()
+
+    def _add_demand(self, interval, sign=1):
+        # The number of polls per second the intervals ask for, compared to the cap
+        if interval > 0:
+            self.demand = max(0.0, self.demand + sign / float(interval))
+
+        over = bool(self.max_rate) and self.demand > self.max_rate * (1 + 1e-9)
+        if over and not self.over_rate:
+            log.msg('The poll intervals need %.2f polls per second, more than max_rate %s: '
+                    'polls will be later than their refresh time' % (self.demand, self.max_rate))
+        self.over_rate = over
+
+    def start(self):
+        self.running = True
+        self._wakeup()
+
+    def _wakeup(self):
+        if not self.running:
+            return
+
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            return
+
+        delay = max(0, self.heap[0][0] - self.clock.seconds())
+        if self.timer and self.timer.active():
+            if self.timer.getTime() <= self.clock.seconds() + delay:
+                return
+            self.timer.cancel()
+
+        self.timer = self.clock.callLater(delay, self._run)
+
+    def _refill(self, now):
+        if self.max_rate:
+            self.tokens = min(max(1.0, self.max_rate), self.tokens + (now - self.last_refill) * self.max_rate)
+        self.last_refill = now
+
+    def _run(self):
+        self.timer = None
+        now = self.clock.seconds()
+        self._refill(now)
+
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            key = entry[2]
+            if key is None:
+                continue
+
+            if self.max_rate and self.tokens < 1.0 - 1e-6:
+                # Over the global rate, try again when the next token is available
+                heapq.heappush(self.heap, entry)
+                self.timer = self.clock.callLater(max((1.0 - self.tokens) / self.max_rate, 1e-3), self._run)
+                return
+
+            self.tokens -= 1.0
+
+            interval = entry[4]
+            next_due = now + interval * (1.0 + random.uniform(-self.jitter, self.jitter))
+            new_entry = [next_due, next(self.counter), key, entry[3], interval]
+            self.entries[key] = new_entry
+            heapq.heappush(self.heap, new_entry)
+
+            try:
+                self.callback(entry[3])
+            except Exception:
+                log.err(None, 'Scheduled poll failed')
+
+        self._wakeup()
+
+class RateLimiter():
+    '''
+    This class spaces calls out so no more than a given number per second are made.
+    '''
+    def __init__(self, rate, clock=reactor):
+        '''
+        @param rate: maximum number of calls per second, 0 to disable
+        @param clock: the reactor used for timing
+        '''
+        self.rate = rate
+        self.clock = clock
+        self.next_time = 0
+
+    def acquire(self):
+        '''
+        Wait for a free slot.
+        @return: a Deferred firing when the call may be made
+        '''
+        if not self.rate:
+            return defer.succeed(None)
+
+        now = self.clock.seconds()
+        start = max(now, self.next_time)
+        self.next_time = start + 1.0 / self.rate
+
+        if start <= now:
+            return defer.succeed(None)
+        return task.deferLater(self.clock, start - now, lambda: None)
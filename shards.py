@@ -0,0 +1,381 @@
+import os
+import sys
+import json
+import time
+import hashlib
+from math import ceil
+from twisted.internet import reactor, protocol, defer
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.python import log
+from stats import Stats
+
+def ranking(name, shards):
+    '''
+    Get the shards in order of preference for an account (rendezvous hashing).
+    The order only depends on the name and the number of shards, so it is the same in every run.
+    '''
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return sorted(range(shards), key=lambda shard: hashlib.md5('%s/%d' % (name, shard)).digest(), reverse=True)
+
+def capacity(accounts, shards, balance):
+    return max(1, int(ceil(accounts * balance / float(shards))))
+
+def assign(names, shards, balance=1.1):
+    '''
+    Assign accounts to shards. Every account goes to the most preferred shard
+    that is not full, so no shard gets more than balance times its fair share.
+    @param names: the account user names
+    @param shards: the number of shards
+    @param balance: the maximum load of a shard relative to the average
+    @return: dictionary of account user name to shard
+    '''
+    limit = capacity(len(names), shards, balance)
+    loads = [0] * shards
+    result = {}
+    for name in sorted(names):
+        for shard in ranking(name, shards):
+            if loads[shard] < limit:
+                break
+        result[name] = shard
+        loads[shard] += 1
+    return result
+
+class WorkerProcess(protocol.ProcessProtocol):
+    '''
+    The supervisor side of the connection to a worker process.
+    Messages are JSON objects, one per line, on the standard input and output of the worker.
+    '''
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, supervisor, shard):
+        self.supervisor = supervisor
+        self.shard = shard
+        self.buffer = ''
+        self.errors = ''
+        self.ended = defer.Deferred()
+
+    def send(self, message):
+        self.transport.write(json.dumps(message) + '\n')
+
+    def outReceived(self, data):
+        self.buffer += data
+        if len(self.buffer) > self.MAX_LENGTH:
+            log.msg('Message from latitude shard %d too long, restarting it' % self.shard)
+            self.transport.signalProcess('KILL')
+            return
+
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                self.supervisor.message_received(self.shard, json.loads(line))
+            except Exception:
+                log.err(None, 'Unable to handle message from latitude shard %d' % self.shard)
+
+    def errReceived(self, data):
+        # Worker log output
+        lines = (self.errors + data).split('\n')
+        self.errors = lines.pop()
+        for line in lines:
+            log.msg('[shard %d] %s' % (self.shard, line))
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self.shard, reason)
+        self.ended.callback(None)
+
+class ShardSupervisor():
+    '''
+    This class splits the accounts over a number of worker processes, each running its
+    own polling pipeline. It stands in for the Latitude poller of the wrapper: the wrapper
+    keeps the configuration and the connection to the coordinator, and the workers send
+    their value updates, tokens, position changes and statistics back to it.
+    Workers that end are started again with their accounts.
+    '''
+    def __init__(self, wrapper, workers, script, restart_delay=5, balance=1.1):
+        '''
+        @param wrapper: the LatitudeWrapper holding the accounts and locations
+        @param workers: the number of worker processes
+        @param script: the script the workers run, it is passed --shard <index> <workers>
+        @param restart_delay: number of seconds before a worker that ended is started again
+        @param balance: the maximum number of accounts of a worker relative to the average
+        '''
+        self.wrapper = wrapper
+        self.count = workers
+        self.script = script
+        self.restart_delay = restart_delay
+        self.balance = balance
+        self.assignment = assign([acc.username for acc in wrapper.accounts], workers, balance)
+        self.loads = [0] * workers
+        for shard in self.assignment.itervalues():
+            self.loads[shard] += 1
+        self.accounts = dict((acc.username, acc) for acc in wrapper.accounts)
+        self.workers = [None] * workers
+        self.pending = {}
+        self.next_id = 0
+        self.stopping = False
+        self.started = time.time()
+
+        for shard in range(workers):
+            self.spawn(shard)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, shard):
+        '''
+        Start a worker and send it the locations and its accounts.
+        '''
+        if self.stopping:
+            return
+
+        worker = WorkerProcess(self, shard)
+        args = [sys.executable, self.script, '--shard', str(shard), str(self.count)]
+        reactor.spawnProcess(worker, sys.executable, args, env=os.environ, path=os.getcwd())
+        self.workers[shard] = worker
+
+        worker.send({'type': 'locations', 'locations': self.wrapper.locations})
+        for acc in self.wrapper.accounts:
+            if self.assignment.get(acc.username) == shard:
+                self.send_account(acc)
+
+    def worker_ended(self, shard, reason):
+        self.workers[shard] = None
+        for id, (worker, d) in self.pending.items():
+            if worker == shard:
+                del self.pending[id]
+                d.errback(Exception('Latitude shard %d ended' % shard))
+
+        if not self.stopping:
+            log.msg('Latitude shard %d ended (%s), restarting it' % (shard, reason.getErrorMessage()))
+            reactor.callLater(self.restart_delay, self.spawn, shard)
+
+    def stop(self):
+        '''
+        Stop all workers, closing their input makes them stop.
+        @return: a Deferred firing when all workers ended
+        '''
+        self.stopping = True
+        ended = []
+        for worker in self.workers:
+            if worker is not None:
+                worker.transport.closeStdin()
+                ended.append(worker.ended)
+                reactor.callLater(5, self.kill, worker)
+        return defer.DeferredList(ended)
+
+    def kill(self, worker):
+        if not worker.ended.called:
+            worker.transport.signalProcess('KILL')
+
+    def send(self, shard, message):
+        worker = self.workers[shard]
+        # A worker being restarted gets the current state when it starts
+        if worker is not None:
+            worker.send(message)
+
+    def broadcast(self, message):
+        for shard in range(self.count):
+            self.send(shard, message)
+
+    def send_account(self, acc):
+        '''
+        Send the details, token and last known position of an account to the worker polling it.
+        '''
+        self.send(self.assignment[acc.username],
+                  {'type': 'account', 'name': acc.username,
+                   'details': [acc.device_id, acc.password, acc.refreshtime, acc.proximity],
+                   'token': acc.token, 'token_time': acc.token_time,
+                   'state': {'latitude': acc.latitude, 'longitude': acc.longitude, 'timestamp': acc.timestamp,
+                             'location': acc.location, 'interval': acc.interval}})
+
+    def move(self, name, shard):
+        old = self.assignment.pop(name, None)
+        if old is not None:
+            self.loads[old] -= 1
+            self.send(old, {'type': 'del_account', 'name': name})
+
+        acc = self.accounts.pop(name, None) or self.wrapper.get_account(name)
+        if shard is not None:
+            self.assignment[name] = shard
+            self.loads[shard] += 1
+            self.accounts[name] = acc
+            self.send_account(acc)
+
+    def rebalance(self):
+        '''
+        Move the accounts that are not on the shard assigned to them by assign.
+        '''
+        assignment = assign([acc.username for acc in self.wrapper.accounts], self.count, self.balance)
+        for name in [name for name in self.assignment if name not in assignment]:
+            self.move(name, None)
+        for name, shard in assignment.iteritems():
+            if self.assignment.get(name) != shard:
+                self.move(name, shard)
+
+    def add_account(self, account):
+        '''
+        Start polling a new account, or send the changed details of an account to its worker.
+        '''
+        if account.username in self.assignment:
+            self.send_account(account)
+            return
+
+        # The most preferred shard with room, a new account does not move others
+        limit = capacity(len(self.assignment) + 1, self.count, self.balance)
+        for shard in ranking(account.username, self.count):
+            if self.loads[shard] < limit:
+                break
+        self.move(account.username, shard)
+
+    def remove_account(self, account):
+        '''
+        Stop polling an account, accounts move to other shards when the shards are no longer balanced.
+        '''
+        self.move(account.username, None)
+        if max(self.loads) > capacity(len(self.assignment), self.count, self.balance) + 1:
+            self.rebalance()
+
+    def set_location(self, name, coordinates):
+        self.broadcast({'type': 'location', 'name': name, 'coordinates': coordinates})
+
+    def remove_location(self, name):
+        self.broadcast({'type': 'del_location', 'name': name})
+
+    def request(self, shard, message, timeout=30):
+        '''
+        Send a message to a worker and wait for its reply.
+        @return: a Deferred firing with the result of the worker
+        '''
+        if self.workers[shard] is None:
+            return defer.fail(Exception('Latitude shard %d is not running' % shard))
+
+        self.next_id += 1
+        message['id'] = self.next_id
+        d = defer.Deferred()
+        self.pending[self.next_id] = (shard, d)
+        self.send(shard, message)
+
+        def expire(id):
+            if id in self.pending:
+                self.pending.pop(id)[1].errback(Exception('Latitude shard %d did not reply' % shard))
+        call = reactor.callLater(timeout, expire, self.next_id)
+
+        def done(result):
+            if call.active():
+                call.cancel()
+            return result
+        return d.addBoth(done)
+
+    @defer.inlineCallbacks
+    def collect_stats(self, accounts=True):
+        '''
+        Get the combined statistics of all workers.
+        @param accounts: whether to include the per account statistics
+        @return: a Deferred firing with a dictionary with the stats, http and geocode_cache statistics
+        '''
+        results = yield defer.DeferredList([self.request(shard, {'type': 'stats', 'accounts': accounts})
+                                            for shard in range(self.count)], consumeErrors=True)
+        stats = Stats()
+        stats.started = self.started
+        http = {}
+        cache = {}
+        for success, result in results:
+            if not success:
+                log.msg('Incomplete latitude statistics: %s' % result.getErrorMessage())
+                continue
+
+            stats.merge(result['stats'])
+            for total, values in ((http, result['http']), (cache, result['geocode_cache'])):
+                for name, value in values.iteritems():
+                    total[name] = total.get(name, 0) + value
+
+        defer.returnValue({'stats': stats, 'http': http, 'geocode_cache': cache})
+
+    def message_received(self, shard, message):
+        '''
+        Handle a message of a worker.
+        '''
+        type = message['type']
+        wrapper = self.wrapper
+
+        if type == 'reply':
+            pending = self.pending.pop(message['id'], None)
+            if pending:
+                pending[1].callback(message['result'])
+            return
+
+        acc = self.accounts.get(message.get('name'))
+        if type == 'value_update':
+            wrapper.pluginapi.value_update(message['address'], message['values'])
+        elif acc is None or self.assignment.get(acc.username) != shard:
+            # The account was removed or moved in the meantime
+            return
+        elif type == 'token':
+            wrapper.set_token(acc, message['token'])
+        elif type == 'fix':
+            acc.latitude, acc.longitude, acc.timestamp = message['latitude'], message['longitude'], message['timestamp']
+            if wrapper.history:
+                wrapper.history.record(acc)
+        elif type == 'change':
+            details = message['details']
+            acc.latitude, acc.longitude, acc.timestamp = details[4], details[5], message['timestamp']
+            acc.lastupdate, acc.interval, acc.location = details[6], details[7], details[8]
+            wrapper.changes.record(acc.username, details)
+
+class WorkerChannel(LineOnlyReceiver):
+    '''
+    The worker side of the connection to the supervisor, on standard input and output.
+    It also stands in for the PluginAPI of the worker.
+    '''
+    delimiter = '\n'
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, handler):
+        '''
+        @param handler: function called with every message of the supervisor
+        '''
+        self.handler = handler
+
+    def lineReceived(self, line):
+        try:
+            self.handler(json.loads(line))
+        except Exception:
+            log.err(None, 'Unable to handle message from the latitude supervisor')
+
+    def connectionLost(self, reason):
+        # The supervisor stopped
+        if reactor.running:
+            reactor.stop()
+
+    def send(self, type, **message):
+        message['type'] = type
+        self.sendLine(json.dumps(message))
+
+    def value_update(self, address, values):
+        self.send('value_update', address=address, values=values)
+
+class RemoteChangeLog():
+    '''
+    Stands in for the ChangeLog of a worker, changes are sent to the supervisor.
+    '''
+    def __init__(self, channel, wrapper):
+        self.channel = channel
+        self.wrapper = wrapper
+
+    def record(self, name, details):
+        acc = self.wrapper.get_account(name)
+        self.channel.send('change', name=name, details=details, timestamp=acc.timestamp if acc else None)
+
+    def remove(self, name):
+        pass
+
+class RemoteHistory():
+    '''
+    Stands in for the PositionHistory of a worker, fixes are stored by the supervisor.
+    '''
+    def __init__(self, channel):
+        self.channel = channel
+
+    def record(self, account):
+        self.channel.send('fix', name=account.username, latitude=account.latitude,
+                          longitude=account.longitude, timestamp=account.timestamp)
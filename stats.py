@@ -0,0 +1,174 @@
+import time
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram():
+    '''
+    This class keeps a latency histogram with fixed buckets, plus an error count.
+    '''
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, p):
+        '''
+        Get an upper bound for a percentile, in seconds.
+        '''
+        if not self.count:
+            return 0.0
+
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                # Capped at the largest bucket, so the result stays valid JSON
+                return BUCKETS[min(i, len(BUCKETS) - 1)]
+
+    def merge(self, snapshot):
+        '''
+        Add the counts of a histogram snapshot to this histogram.
+        '''
+        self.count += snapshot['count']
+        self.sum += snapshot['sum']
+        self.errors += snapshot['errors']
+        self.buckets = [a + b for a, b in zip(self.buckets, snapshot['buckets'])]
+
+    def snapshot(self):
+        return {'count': self.count,
+                'errors': self.errors,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'buckets': self.buckets[:]}
+
+class Stats():
+    '''
+    This class collects per stage timings and error counts, overall and per account.
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.accounts = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def _histograms(self, stage, account):
+        result = [self.stages.setdefault(stage, Histogram())]
+        if account is not None:
+            result.append(self.accounts.setdefault(account, {}).setdefault(stage, Histogram()))
+        return result
+
+    def observe(self, stage, seconds, account=None):
+        '''
+        Record the duration of a stage.
+        @param stage: the name of the stage
+        @param seconds: the duration in seconds
+        @param account: optional user name of the account
+        '''
+        for histogram in self._histograms(stage, account):
+            histogram.observe(seconds)
+
+    def error(self, stage, account=None):
+        '''
+        Record a failure of a stage.
+        '''
+        for histogram in self._histograms(stage, account):
+            histogram.errors += 1
+
+    def increment(self, name, amount=1):
+        '''
+        Increment a counter.
+        '''
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def measure(self, stage, d, account=None):
+        '''
+        Record the time until a Deferred fires, failures are counted as errors.
+        @return: the Deferred
+        '''
+        start = time.time()
+
+        def done(result):
+            self.observe(stage, time.time() - start, account)
+            return result
+
+        def failed(failure):
+            self.error(stage, account)
+            return failure
+
+        return d.addCallbacks(done, failed)
+
+    def remove_account(self, account):
+        self.accounts.pop(account, None)
+
+    def merge(self, snapshot):
+        '''
+        Add a snapshot of other statistics, for example those of another process, to these statistics.
+        @param snapshot: the result of snapshot
+        '''
+        for stage, h in snapshot['stages'].iteritems():
+            self.stages.setdefault(stage, Histogram()).merge(h)
+
+        for account, stages in snapshot.get('accounts', {}).iteritems():
+            for stage, h in stages.iteritems():
+                self.accounts.setdefault(account, {}).setdefault(stage, Histogram()).merge(h)
+
+        for name, value in snapshot['counters'].iteritems():
+            self.increment(name, value)
+
+    def snapshot(self, accounts=True):
+        '''
+        Get all statistics.
+        @param accounts: whether to include the per account statistics
+        @return: dictionary with stage histograms, counters and optionally per account histograms
+        '''
+        result = {'uptime': time.time() - self.started,
+                  'buckets': list(BUCKETS),
+                  'stages': dict((stage, h.snapshot()) for stage, h in self.stages.iteritems()),
+                  'counters': dict(self.counters)}
+
+        if accounts:
+            result['accounts'] = dict((account, dict((stage, h.snapshot()) for stage, h in stages.iteritems()))
+                                      for account, stages in self.accounts.iteritems())
+        return result
+
+    def prometheus(self, extra=None):
+        '''
+        Format the overall statistics in the Prometheus text exposition format.
+        @param extra: optional dictionary of additional gauge names to values
+        '''
+        lines = ['# TYPE latitude_stage_seconds histogram']
+        for stage, h in sorted(self.stages.iteritems()):
+            seen = 0
+            for bound, n in zip(BUCKETS + ('+Inf',), h.buckets):
+                seen += n
+                lines.append('latitude_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, seen))
+            lines.append('latitude_stage_seconds_sum{stage="%s"} %f' % (stage, h.sum))
+            lines.append('latitude_stage_seconds_count{stage="%s"} %d' % (stage, h.count))
+
+        lines.append('# TYPE latitude_stage_errors_total counter')
+        for stage, h in sorted(self.stages.iteritems()):
+            lines.append('latitude_stage_errors_total{stage="%s"} %d' % (stage, h.errors))
+
+        for name, value in sorted(self.counters.iteritems()):
+            lines.append('# TYPE latitude_%s_total counter' % name)
+            lines.append('latitude_%s_total %d' % (name, value))
+
+        for name, value in sorted((extra or {}).iteritems()):
+            lines.append('# TYPE latitude_%s gauge' % name)
+            lines.append('latitude_%s %s' % (name, value))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,96 @@
+import os
+import sys
+import types
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# latitude.py imports the HouseAgent plugin API, which is not needed here
+if 'houseagent' not in sys.modules:
+    houseagent = types.ModuleType('houseagent')
+    houseagent.config_path = '.'
+    houseagent.plugins = types.ModuleType('houseagent.plugins')
+    houseagent.plugins.pluginapi = types.ModuleType('houseagent.plugins.pluginapi')
+    sys.modules['houseagent'] = houseagent
+    sys.modules['houseagent.plugins'] = houseagent.plugins
+    sys.modules['houseagent.plugins.pluginapi'] = houseagent.plugins.pluginapi
+
+import geoindex
+from geoindex import LocationIndex, BatchProximity
+from latitude import Latitude
+
+haversine = Latitude.get_distance_by_haversine.im_func
+
+def baseline(locations, lat, lon, proximity):
+    '''
+    The location loop of the original get_latitudedata, returning every location in range.
+    '''
+    result = {}
+    for loc, data in locations.iteritems():
+        km = haversine(None, (lat, lon), (float(data[0]), float(data[1])))
+        if km < proximity:
+            result[loc] = km
+    return result
+
+class BatchProximityTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(2)
+        self.locations = {}
+        for i in range(300):
+            self.locations['loc%d' % i] = [str(random.uniform(51, 53)), str(random.uniform(4, 6))]
+        # Near the antimeridian and the pole
+        self.locations['east'] = ['10.0', '179.99']
+        self.locations['north'] = ['89.99', '0.0']
+
+        self.positions = []
+        for _ in range(500):
+            self.positions.append((random.uniform(50.9, 53.1), random.uniform(3.9, 6.1), random.choice([0.1, 0.5, 2.0, 10.0])))
+        self.positions += [(10.0, -179.995, 2.0), (89.995, 120.0, 2.0), (0.0, 0.0, 5.0)]
+
+    def check(self, matches):
+        self.assertEqual(len(matches), len(self.positions))
+        for (lat, lon, proximity), match in zip(self.positions, matches):
+            expected = baseline(self.locations, lat, lon, proximity)
+            if not expected:
+                self.assertEqual(match, None)
+                continue
+
+            # The original loop took the first location in range, the batch takes the nearest one
+            self.assertNotEqual(match, None)
+            name, km = match
+            self.assertIn(name, expected)
+            self.assertAlmostEqual(km, expected[name], places=6)
+            self.assertAlmostEqual(km, min(expected.itervalues()), places=6)
+
+    def test_scalar(self):
+        numpy = geoindex.numpy
+        geoindex.numpy = None
+        try:
+            self.check(BatchProximity(LocationIndex(self.locations)).nearest(self.positions))
+        finally:
+            geoindex.numpy = numpy
+
+    @unittest.skipIf(geoindex.numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        self.check(BatchProximity(LocationIndex(self.locations), chunk_size=64).nearest(self.positions))
+
+class AntimeridianShapeTest(unittest.TestCase):
+    def setUp(self):
+        self.index = LocationIndex({'square': ['', '', '', [[9.95, 179.9], [9.95, -179.9], [10.05, -179.9], [10.05, 179.9]]],
+                                    'circle': ['-20.0', '179.99', '2.0']})
+
+    def test_polygon(self):
+        for lon in (179.95, -179.95):
+            self.assertEqual(list(self.index.shape_candidates(10.0, lon)), ['square'])
+            self.assertTrue(self.index.excess('square', 10.0, lon, 1.0) < 0)
+        for lon in (179.85, -179.85, 0.0):
+            self.assertEqual(list(self.index.shape_candidates(10.0, lon)), [])
+            self.assertTrue(self.index.excess('square', 10.0, lon, 1.0) > 0)
+
+    def test_circle(self):
+        self.assertEqual(list(self.index.shape_candidates(-20.0, -179.995)), ['circle'])
+        self.assertEqual(self.index.nearest_shape(-20.0, -179.995)[0], 'circle')
+
+if __name__ == '__main__':
+    unittest.main()
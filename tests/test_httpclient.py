@@ -0,0 +1,40 @@
+import os
+import sys
+
+from twisted.internet import reactor, defer, protocol
+from twisted.trial import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from httpclient import HTTPClient
+
+class Silent(protocol.Protocol):
+    '''
+    Accepts the request and never answers.
+    '''
+    def connectionMade(self):
+        self.factory.connections.append(self.transport)
+
+class HTTPClientTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        factory = protocol.ServerFactory()
+        factory.protocol = Silent
+        factory.connections = self.connections = []
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/' % self.port.getHost().port
+        self.client = HTTPClient(read_timeout=0.2)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for transport in self.connections:
+            transport.loseConnection()
+        yield self.client.close()
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        yield self.assertFailure(self.client.getPage(self.url), defer.TimeoutError)
+        stats = self.client.stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['active'], 0)